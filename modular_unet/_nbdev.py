@@ -2,17 +2,67 @@
 
 __all__ = ["index", "modules", "custom_doc_links", "git_url"]
 
-index = {"ConvLayer": "blocks.ipynb",
+index = {"model_class": "benchmark.ipynb",
+         "peak_rss_mib": "benchmark.ipynb",
+         "benchmark_model": "benchmark.ipynb",
+         "run_benchmarks": "benchmark.ipynb",
+         "precision_report": "benchmark.ipynb",
+         "shape_policy_report": "benchmark.ipynb",
+         "load_time": "benchmark.ipynb",
+         "startup_report": "benchmark.ipynb",
+         "scaling_report": "benchmark.ipynb",
+         "streaming_time": "benchmark.ipynb",
+         "streaming_report": "benchmark.ipynb",
+         "compare_benchmarks": "benchmark.ipynb",
+         "LOWER_IS_BETTER": "benchmark.ipynb",
+         "benchmark": "benchmark.ipynb",
+         "FactorizedConv3d": "blocks.ipynb",
+         "SeparableConv3d": "blocks.ipynb",
+         "CONV_MODES": "blocks.ipynb",
+         "ConvLayer": "blocks.ipynb",
          "DropConnect": "blocks.ipynb",
+         "StochasticDepth": "blocks.ipynb",
          "SqueezeExpand": "blocks.ipynb",
          "MBConvBlock": "blocks.ipynb",
+         "SigmoidFloat32": "blocks.ipynb",
+         "SoftmaxFloat32": "blocks.ipynb",
          "SpatialAttention": "blocks.ipynb",
          "SpatialAttentionDualInput": "blocks.ipynb",
+         "resize_like": "blocks.ipynb",
          "UnetBlock": "blocks.ipynb",
          "ResBlock": "blocks.ipynb",
          "DoubleConv": "blocks.ipynb",
          "DeepSupervision": "blocks.ipynb",
          "res_blocks": "blocks.ipynb",
+         "conv_macs": "estimate.ipynb",
+         "conv_transpose_macs": "estimate.ipynb",
+         "linear_macs": "estimate.ipynb",
+         "MAC_COUNTERS": "estimate.ipynb",
+         "MemoryTracker": "estimate.ipynb",
+         "estimate": "estimate.ipynb",
+         "inference_peak_mib": "estimate.ipynb",
+         "export_onnx": "export.ipynb",
+         "OnnxPredictor": "export.ipynb",
+         "save_checkpoint": "export.ipynb",
+         "empty_model": "export.ipynb",
+         "load_checkpoint": "export.ipynb",
+         "valid_tile_size": "inference.ipynb",
+         "tile_starts": "inference.ipynb",
+         "gaussian_weight_map": "inference.ipynb",
+         "PredictionAccumulator": "inference.ipynb",
+         "ACCUMULATOR_DTYPES": "inference.ipynb",
+         "SlidingWindowPredictor": "inference.ipynb",
+         "ProcessPoolPredictor": "inference.ipynb",
+         "open_volume": "inference.ipynb",
+         "StreamingPredictor": "inference.ipynb",
+         "apply_tta": "inference.ipynb",
+         "invert_tta": "inference.ipynb",
+         "tta_transforms": "inference.ipynb",
+         "TTAPredictor": "inference.ipynb",
+         "TileSelector": "inference.ipynb",
+         "bounding_box": "inference.ipynb",
+         "merge_boxes": "inference.ipynb",
+         "CascadePredictor": "inference.ipynb",
          "UResNet": "models.ipynb",
          "UResNet18": "models.ipynb",
          "UResNet18WithAttention": "models.ipynb",
@@ -30,15 +80,52 @@ index = {"ConvLayer": "blocks.ipynb",
          "UResNet50DeepSupervision": "models.ipynb",
          "UResNet50WithAttentionAndDeepSupervision": "models.ipynb",
          "UResNet50WithSEAndAttentionAndDeepSupervision": "models.ipynb",
+         "scale_channels": "models.ipynb",
+         "compound_scaling": "models.ipynb",
+         "EfficientUNet": "models.ipynb",
+         "EfficientUNetB0": "models.ipynb",
+         "EfficientUNetB1": "models.ipynb",
+         "EfficientUNetB2": "models.ipynb",
+         "EfficientUNetB3": "models.ipynb",
+         "add_upsampled": "modular_unet.ipynb",
+         "pad_to_multiple": "modular_unet.ipynb",
+         "crop_padding": "modular_unet.ipynb",
+         "keep_running_stats": "modular_unet.ipynb",
+         "update_stats_once": "modular_unet.ipynb",
          "ModularUNet": "modular_unet.ipynb",
+         "load_legacy_state_dict": "modular_unet.ipynb",
+         "checkpoint_cost": "modular_unet.ipynb",
+         "fuse_conv_bn": "optimize.ipynb",
+         "ChannelAffine": "optimize.ipynb",
+         "fuse_for_inference": "optimize.ipynb",
+         "StaticUNet": "optimize.ipynb",
+         "script_for_inference": "optimize.ipynb",
+         "plan_topology": "planner.ipynb",
+         "plan": "planner.ipynb",
+         "StageProfiler": "profiling.ipynb",
+         "quantize": "quantization.ipynb",
+         "dice_score": "quantization.ipynb",
+         "quantization_report": "quantization.ipynb",
+         "BatchingPredictor": "serving.ipynb",
+         "serve_http": "serving.ipynb",
          "all_equal": "utils.ipynb",
          "first_layer": "utils.ipynb",
          "hasattrs": "utils.ipynb",
+         "percentile": "utils.ipynb",
          "test_forward": "utils.ipynb"}
 
-modules = ["blocks.py",
+modules = ["benchmark.py",
+           "blocks.py",
+           "estimate.py",
+           "export.py",
+           "inference.py",
            "models.py",
            "modular_unet.py",
+           "optimize.py",
+           "planner.py",
+           "profiling.py",
+           "quantization.py",
+           "serving.py",
            "utils.py"]
 
 doc_url = "https://kbressem.github.io/modular_unet/"
@@ -0,0 +1,327 @@
+# AUTOGENERATED! DO NOT EDIT! File to edit: nbs/benchmark.ipynb (unless otherwise specified).
+
+__all__ = ['model_class', 'peak_rss_mib', 'benchmark_model', 'run_benchmarks', 'precision_report',
+           'shape_policy_report', 'load_time', 'startup_report', 'scaling_report', 'streaming_time', 'streaming_report',
+           'compare_benchmarks', 'LOWER_IS_BETTER', 'benchmark']
+
+# Cell
+# default_exp benchmark
+import os
+import json
+import math
+import time
+import torch
+import numpy as np
+import resource
+import tempfile
+import subprocess
+from pathlib import Path
+
+from fastcore.script import call_parse, Param, store_true
+
+# Cell
+import sys
+sys.path.append('..')
+from .models import *
+from .models import __all__ as MODELS
+from .utils import percentile
+from .estimate import inference_peak_mib
+from .export import save_checkpoint, load_checkpoint
+from .inference import SlidingWindowPredictor, ProcessPoolPredictor, StreamingPredictor
+
+# Cell
+def model_class(name):
+    " Get a model class from `modular_unet.models` by its name "
+    if name not in MODELS: raise ValueError(f'{name} is not a model in `modular_unet.models`')
+    return globals()[name]
+
+# Cell
+def peak_rss_mib():
+    " Peak resident set size of the current process in MiB "
+    if os.path.exists('/proc/self/status'): # unlike `ru_maxrss`, not inherited from the parent across `fork` and `exec`
+        with open('/proc/self/status') as f: return next(int(l.split()[1]) for l in f if l.startswith('VmHWM')) / 2**10
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2**20 if sys.platform == 'darwin' else peak / 2**10 # bytes on macOS, KiB on Linux
+
+# Cell
+def benchmark_model(model_name, # name of a model in `modular_unet.models`
+                    inp_sz=(64, 64, 64), # spatial size of the input
+                    batch_size=1,
+                    n_threads=1, # number of intra-op threads
+                    in_c=1, # number of input channels
+                    n_classes=2, # number of output channels
+                    n_warmup=1, # untimed iterations before measuring
+                    n_iter=5, # timed iterations
+                    train=True # also time a training step
+                   ):
+    " Measure latency, throughput, peak memory and parameter count of one model configuration "
+    threads = torch.get_num_threads()
+    torch.set_num_threads(n_threads)
+    try:
+        model = model_class(model_name)(in_c, n_classes)
+        x = torch.randn(batch_size, in_c, *inp_sz)
+        result = {'model': model_name, 'inp_sz': list(inp_sz), 'batch_size': batch_size, 'n_threads': n_threads,
+                  'n_params': sum(p.numel() for p in model.parameters())}
+
+        model.eval()
+        times = []
+        with torch.no_grad():
+            for i in range(n_warmup + n_iter):
+                start = time.perf_counter()
+                model(x)
+                if i >= n_warmup: times.append(time.perf_counter() - start)
+        result['latency_p50_s'] = percentile(times, 50)
+        result['latency_p95_s'] = percentile(times, 95)
+        result['voxels_per_s'] = x[:, 0].numel() / result['latency_p50_s']
+
+        if train:
+            model.train()
+            opt = torch.optim.SGD(model.parameters(), lr=1e-6)
+            times = []
+            for i in range(n_warmup + n_iter):
+                start = time.perf_counter()
+                model(x).mean().backward()
+                opt.step()
+                opt.zero_grad()
+                if i >= n_warmup: times.append(time.perf_counter() - start)
+            result['train_step_s'] = percentile(times, 50)
+        result['peak_rss_mib'] = peak_rss_mib()
+    finally: torch.set_num_threads(threads)
+    return result
+
+# Cell
+_RUN = 'import sys, json; from modular_unet import benchmark; ' \
+       'print(json.dumps(getattr(benchmark, sys.argv[1])(**json.loads(sys.argv[2]))))'
+
+def _run_isolated(kwargs, fn='benchmark_model'):
+    " Run `fn` of this module in a fresh python interpreter "
+    env = {**os.environ, 'PYTHONPATH': os.pathsep.join(sys.path)}
+    proc = subprocess.run([sys.executable, '-c', _RUN, fn, json.dumps(kwargs)], capture_output=True, text=True, env=env)
+    if proc.returncode != 0: raise RuntimeError(proc.stderr.strip().split('\n')[-1])
+    return json.loads(proc.stdout.strip().split('\n')[-1])
+
+def run_benchmarks(model_names, # names of models in `modular_unet.models`
+                   inp_szs=((64, 64, 64), ), # list of spatial input sizes
+                   batch_sizes=(1, ),
+                   n_threads=(1, ), # list of intra-op thread counts
+                   isolate=True, # run each configuration in a fresh process
+                   **kwargs # further arguments for `benchmark_model`
+                  ):
+    " Benchmark all combinations of models, input sizes, batch sizes and thread counts "
+    results = []
+    for name in model_names:
+        for inp_sz in inp_szs:
+            for bs in batch_sizes:
+                for threads in n_threads:
+                    run_kwargs = dict(model_name=name, inp_sz=tuple(inp_sz), batch_size=bs, n_threads=threads, **kwargs)
+                    try: results.append(_run_isolated(run_kwargs) if isolate else benchmark_model(**run_kwargs))
+                    except Exception as e: # e.g. out of memory, keep benchmarking the other configurations
+                        results.append({**run_kwargs, 'inp_sz': list(inp_sz), 'error': repr(e)})
+    return results
+
+# Cell
+@torch.no_grad()
+def precision_report(model_names, # names of models in `modular_unet.models`
+                     precisions=('bfloat16', 'float16'),
+                     inp_sz=(64, 64, 64), # spatial size of the input
+                     batch_size=1,
+                     in_c=1, # number of input channels
+                     n_classes=2 # number of output channels
+                    ):
+    " Max absolute error and label agreement of reduced precision inference compared to float32 for each model "
+    results = []
+    for name in model_names:
+        model = model_class(name)(in_c, n_classes).eval()
+        x = torch.randn(batch_size, in_c, *inp_sz)
+        ref = model(x)
+        for precision in precisions:
+            model.precision = precision
+            out = model(x)
+            results.append({'model': name, 'precision': precision, 'max_abs_error': (out - ref).abs().max().item(),
+                            'label_agreement': (out.argmax(1) == ref.argmax(1)).float().mean().item()})
+    return results
+
+# Cell
+@torch.no_grad()
+def shape_policy_report(model_names, # names of models in `modular_unet.models`
+                        sizes, # spatial input sizes
+                        n_iter=3, # timed iterations, the fastest is reported
+                        in_c=1, # number of input channels
+                        n_classes=2 # number of output channels
+                       ):
+    " Latency and peak activation memory of inference with `shape_policy='resize'` and `'pad'` for each size "
+    results = []
+    for name in model_names:
+        model = model_class(name)(in_c, n_classes).eval()
+        for sz in sizes:
+            x = torch.randn(1, in_c, *sz)
+            for policy in ('resize', 'pad'):
+                model.shape_policy = policy
+                model(x) # warmup
+                times = []
+                for _ in range(n_iter):
+                    start = time.perf_counter()
+                    model(x)
+                    times.append(time.perf_counter() - start)
+                results.append({'model': name, 'inp_sz': list(sz), 'shape_policy': policy, 'latency_s': min(times),
+                                'peak_mib': inference_peak_mib(model, x.shape)})
+    return results
+
+# Cell
+def load_time(model_name, # name of a model in `modular_unet.models`
+              fname, # weights saved by `export.save_checkpoint`
+              mmap=True, # use `export.load_checkpoint`, otherwise build the model and call `load_state_dict`
+              in_c=1, # number of input channels
+              n_classes=2 # number of output channels
+             ):
+    " Time and peak memory to build a model and load its weights "
+    import_rss = peak_rss_mib()
+    start = time.perf_counter()
+    if mmap: model = load_checkpoint(model_class(model_name), fname, in_c, n_classes)
+    else:
+        model = model_class(model_name)(in_c, n_classes)
+        model.load_state_dict(torch.load(str(fname), map_location='cpu', weights_only=True))
+    return {'model': model_name, 'mmap': mmap, 'startup_s': time.perf_counter() - start,
+            'import_rss_mib': import_rss, 'peak_rss_mib': peak_rss_mib()}
+
+def startup_report(model_names, # names of models in `modular_unet.models`
+                   in_c=1, # number of input channels
+                   n_classes=2 # number of output channels
+                  ):
+    " Startup time and peak memory of loading a checkpoint with and without `export.load_checkpoint` "
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for name in model_names:
+            fname = save_checkpoint(model_class(name)(in_c, n_classes), Path(tmp)/f'{name}.pt')
+            for mmap in (False, True):
+                kwargs = dict(model_name=name, fname=str(fname), mmap=mmap, in_c=in_c, n_classes=n_classes)
+                try: results.append(_run_isolated(kwargs, 'load_time'))
+                except Exception as e: results.append({**kwargs, 'error': repr(e)}) # e.g. out of memory
+    return results
+
+# Cell
+def scaling_report(model_names, # names of models in `modular_unet.models`
+                   n_workers=(1, 2, 4), # numbers of worker processes
+                   inp_sz=(128, 128, 128), # spatial size of the volume
+                   tile_size=(64, 64, 64),
+                   n_threads=1, # intra-op threads per worker
+                   batch_size=1, # number of tiles per forward pass, in the current process and in each worker
+                   in_c=1, # number of input channels
+                   n_classes=2 # number of output channels
+                  ):
+    " Latency and speedup of tile inference with 1 to `max(n_workers)` worker processes "
+    threads = torch.get_num_threads()
+    results = []
+    x = torch.randn(1, in_c, *inp_sz)
+    for name in model_names:
+        model = model_class(name)(in_c, n_classes).eval()
+        torch.set_num_threads(n_threads)
+        try:
+            predictor = SlidingWindowPredictor(model, tile_size, batch_size=batch_size)
+            predictor(x) # warmup, like the workers
+            start = time.perf_counter()
+            predictor(x)
+            baseline = time.perf_counter() - start
+        finally: torch.set_num_threads(threads)
+        for n in n_workers:
+            with ProcessPoolPredictor(model, tile_size, batch_size=batch_size, n_workers=n, n_threads=n_threads) as predictor:
+                predictor(x) # warmup, the first call waits for the workers to start
+                start = time.perf_counter()
+                predictor(x)
+                latency = time.perf_counter() - start
+            results.append({'model': name, 'n_workers': n, 'n_threads': n_threads, 'batch_size': batch_size, 'latency_s': latency,
+                            'speedup': baseline / latency})
+    return results
+
+# Cell
+def streaming_time(model_name, # name of a model in `modular_unet.models`
+                   fname, # `.npy` file with shape (in_c, *spatial_dims)
+                   mode='prefetch', # 'memory', 'stream' or 'prefetch'
+                   tile_size=(64, 64, 64),
+                   overlap=0.25, # overlap of neighbouring tiles
+                   batch_size=1, # number of tiles per forward pass
+                   in_c=1, # number of input channels
+                   n_classes=2 # number of output channels
+                  ):
+    " Time and peak memory to predict the volume in `fname` and save the prediction next to it "
+    model = model_class(model_name)(in_c, n_classes).eval()
+    dst, import_rss = f'{fname}.{mode}.npy', peak_rss_mib()
+    start = time.perf_counter()
+    if mode == 'memory':
+        x = torch.from_numpy(np.load(fname))[None]
+        np.save(dst, SlidingWindowPredictor(model, tile_size, overlap, batch_size)(x)[0].numpy())
+    else: StreamingPredictor(model, tile_size, overlap, batch_size, prefetch=mode == 'prefetch').predict_file(fname, dst)
+    latency = time.perf_counter() - start
+    n_voxels = math.prod(np.load(fname, mmap_mode='r').shape[-3:])
+    return {'model': model_name, 'mode': mode, 'latency_s': latency, 'voxels_per_s': n_voxels / latency,
+            'import_rss_mib': import_rss, 'peak_rss_mib': peak_rss_mib()}
+
+def streaming_report(model_names, # names of models in `modular_unet.models`
+                     inp_sz=(512, 512, 64), # spatial size of the volume
+                     modes=('memory', 'stream', 'prefetch'),
+                     in_c=1, # number of input channels
+                     **kwargs # further arguments for `streaming_time`
+                    ):
+    " Throughput and peak memory of predicting a volume from disk in memory and streamed slab by slab "
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        fname = str(Path(tmp)/'volume.npy')
+        np.save(fname, np.random.randn(in_c, *inp_sz).astype(np.float32))
+        for name in model_names:
+            for mode in modes:
+                run_kwargs = dict(model_name=name, fname=fname, mode=mode, in_c=in_c, **kwargs)
+                try: results.append(_run_isolated(run_kwargs, 'streaming_time'))
+                except Exception as e: results.append({**run_kwargs, 'error': repr(e)}) # e.g. out of memory
+    return results
+
+# Cell
+# metrics for which larger values are worse, `voxels_per_s` is the only metric where smaller values are worse
+LOWER_IS_BETTER = ('latency_p50_s', 'latency_p95_s', 'train_step_s', 'peak_rss_mib')
+
+def _config(result): return (result['model'], tuple(result['inp_sz']), result['batch_size'], result['n_threads'])
+
+def compare_benchmarks(results, baseline, tolerance=0.1):
+    " Find metrics in `results` which are more than `tolerance` (relative) worse than in `baseline` "
+    baseline = {_config(r): r for r in baseline}
+    regressions = []
+    for r in results:
+        base = baseline.get(_config(r))
+        if base is None: continue
+        for metric in (*LOWER_IS_BETTER, 'voxels_per_s'):
+            if metric not in r or metric not in base: continue
+            change = (r[metric] - base[metric]) / base[metric]
+            if metric == 'voxels_per_s': change = -change
+            if change > tolerance:
+                regressions.append({'model': r['model'], 'inp_sz': r['inp_sz'], 'batch_size': r['batch_size'],
+                                    'n_threads': r['n_threads'], 'metric': metric,
+                                    'baseline': base[metric], 'value': r[metric], 'change': change})
+    return regressions
+
+# Cell
+def _ints(s, sep=','): return [int(o) for o in s.split(sep)]
+
+@call_parse
+def benchmark(names:Param("Comma separated model names or 'all'", str)='UResNet18',
+              sizes:Param("Comma separated input sizes, e.g. 64x64x64,96x96x96", str)='64x64x64',
+              batch_sizes:Param("Comma separated batch sizes", str)='1',
+              threads:Param("Comma separated numbers of intra-op threads", str)='1',
+              n_iter:Param("Number of timed iterations", int)=5,
+              no_train:Param("Skip timing of the training step", store_true)=False,
+              out:Param("Save results as JSON to this file", str)=None,
+              baseline:Param("Compare results to a JSON file from a previous run", str)=None,
+              tolerance:Param("Relative change of a metric which counts as regression", float)=0.1):
+    " Benchmark models from `modular_unet.models` on CPU "
+    # 'all' skips abstract models without configuration like `UResNet`
+    names = [n for n in MODELS if hasattr(model_class(n), 'channels')] if names == 'all' else names.split(',')
+    results = []
+    for name in names:
+        for r in run_benchmarks([name], [_ints(s, 'x') for s in sizes.split(',')], _ints(batch_sizes),
+                                _ints(threads), n_iter=n_iter, train=not no_train):
+            print(json.dumps(r))
+            results.append(r)
+    if out:
+        with open(out, 'w') as f: json.dump(results, f, indent=1)
+    if baseline:
+        with open(baseline) as f: regressions = compare_benchmarks(results, json.load(f), tolerance)
+        for r in regressions: print('REGRESSION', json.dumps(r))
+        if regressions: sys.exit(1)
\ No newline at end of file
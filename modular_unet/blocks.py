@@ -1,13 +1,17 @@
 # AUTOGENERATED! DO NOT EDIT! File to edit: nbs/blocks.ipynb (unless otherwise specified).
 
-__all__ = ['ConvLayer', 'DropConnect', 'SqueezeExpand', 'MBConvBlock', 'SpatialAttention', 'SpatialAttentionDualInput',
-           'UnetBlock', 'ResBlock', 'DoubleConv', 'DeepSupervision', 'res_blocks']
+__all__ = ['FactorizedConv3d', 'SeparableConv3d', 'CONV_MODES', 'ConvLayer', 'DropConnect', 'StochasticDepth',
+           'SqueezeExpand', 'MBConvBlock', 'SigmoidFloat32', 'SoftmaxFloat32', 'SpatialAttention',
+           'SpatialAttentionDualInput', 'resize_like', 'UnetBlock', 'ResBlock', 'DoubleConv', 'DeepSupervision',
+           'res_blocks']
 
 # Cell
 # default_exp blocks
 import torch
+import torch.fx
 from torch import nn
 from torch.nn import functional as F
+from typing import Optional
 from collections import OrderedDict
 
 from fastcore.meta import delegates
@@ -18,6 +22,27 @@ import sys
 sys.path.append('..')
 from .utils import all_equal, test_forward
 
+# Cell
+def _triple(v): return (v, )*3 if isinstance(v, int) else tuple(v)
+
+class FactorizedConv3d(nn.Sequential):
+    " (2+1)D convolution: an in-plane k0 x k1 x 1 convolution followed by a 1 x 1 x k2 convolution "
+    def __init__(self, in_c, out_c, ks, stride=1, padding=0, bias=True, **kwargs):
+        ks, stride, padding = _triple(ks), _triple(stride), _triple(padding)
+        super().__init__(OrderedDict([
+            ('in_plane', nn.Conv3d(in_c, out_c, (*ks[:2], 1), (*stride[:2], 1), (*padding[:2], 0), bias=False, **kwargs)),
+            ('through_plane', nn.Conv3d(out_c, out_c, (1, 1, ks[2]), (1, 1, stride[2]), (0, 0, padding[2]),
+                                        bias=bias, **kwargs))]))
+
+class SeparableConv3d(nn.Sequential):
+    " Depthwise separable convolution: a depthwise convolution followed by a pointwise 1x1x1 convolution "
+    def __init__(self, in_c, out_c, ks, stride=1, padding=0, bias=True, **kwargs):
+        super().__init__(OrderedDict([
+            ('depthwise', nn.Conv3d(in_c, in_c, ks, stride, padding, groups=in_c, bias=False, **kwargs)),
+            ('pointwise', nn.Conv3d(in_c, out_c, 1, bias=bias, **kwargs))]))
+
+CONV_MODES = {'full': nn.Conv3d, 'factorized': FactorizedConv3d, 'separable': SeparableConv3d}
+
 # Cell
 class ConvLayer(nn.Sequential):
     " Construct a Sequence of Conv -> BN -> Act "
@@ -32,8 +57,10 @@ class ConvLayer(nn.Sequential):
                  norm=nn.BatchNorm3d, # type of batch nornalization
                  act=nn.ReLU, # activation function
                  transpose=False, # if transpose convolution should be constructed
+                 conv_mode='full', # 'full', 'factorized' (`FactorizedConv3d`) or 'separable' (`SeparableConv3d`)
                  **kwargs # further arguments for ConvLayer
                 ):
+        assert conv_mode in CONV_MODES, f'Unknown conv_mode {conv_mode}'
         layers = OrderedDict([])
 
         # asymmetric padding
@@ -43,8 +70,12 @@ class ConvLayer(nn.Sequential):
             if all_equal(padding): padding = padding[0]
             else: layers['pad'] = nn.ConstantPad3d(padding[::-1], value=pad_value)
 
+        # transposed convolutions should upsample exactly by `stride`
+        if transpose and len(layers) == 0 and 'output_padding' not in kwargs:
+            kwargs['output_padding'] = self.calculate_output_padding(ks, stride, padding)
+
         # Conv Layer
-        Conv = nn.ConvTranspose3d if transpose else nn.Conv3d
+        Conv = nn.ConvTranspose3d if transpose else CONV_MODES[self.resolve_conv_mode(conv_mode, ks, kwargs)]
         conv_layer = Conv(in_c, out_c, ks, stride=stride,
                           padding=0 if len(layers) == 1 else padding, **kwargs)
 
@@ -56,10 +87,38 @@ class ConvLayer(nn.Sequential):
         # create layers
         super().__init__(layers)
 
+    def resolve_conv_mode(self, conv_mode, ks, kwargs):
+        " Fall back to a full convolution, where a factorized or separable one would be the same or is not possible "
+        ks = (ks, )*3 if isinstance(ks, int) else tuple(ks)
+        if kwargs.get('groups', 1) != 1 or ks == (1, 1, 1): return 'full'
+        if conv_mode == 'factorized' and (ks[:2] == (1, 1) or ks[2] == 1): return 'full'
+        return conv_mode
+
     def calculate_padding(self, ks):
         if ks % 2 == 0: return ks // 2, (ks-1) //2
         else: return ks //2, ks // 2
 
+    def calculate_output_padding(self, ks, stride, padding):
+        ks, stride, padding = [(v, )*3 if isinstance(v, int) else v for v in (ks, stride, padding)]
+        output_padding = tuple(s - k + 2*p for k, s, p in zip(ks, stride, padding))
+        # output_padding must be smaller than stride, else fall back to PyTorch default
+        if all(0 <= op < s for op, s in zip(output_padding, stride)): return output_padding
+        return 0
+
+    def input_projections(self):
+        " The 1x1x1 convolution reading the input, if the layer starts with one, else None "
+        conv = self._modules.get('conv')
+        if 'pad' in self._modules or not isinstance(conv, nn.Conv3d): return None
+        if conv.kernel_size != (1, 1, 1) or conv.stride != (1, 1, 1) or conv.padding != (0, 0, 0) or conv.groups != 1:
+            return None
+        return [conv]
+
+    def forward_from_projections(self, x):
+        " Continue the forward pass after the convolution from `input_projections` "
+        for name, layer in self.named_children():
+            if name != 'conv': x = layer(x)
+        return x
+
 # Cell
 class DropConnect(nn.Module):
     " Drops connections with probability p "
@@ -77,7 +136,32 @@ class DropConnect(nn.Module):
         # generate binary_tensor mask according to probability (p for 0, 1-p for 1)
         random_tensor = self.p + torch.rand([batch_size, 1, 1, 1, 1], dtype=x.dtype,
                                             device=x.device)
-        return x / self.p
+        binary_tensor = torch.floor(random_tensor)
+        return x / self.p * binary_tensor
+
+# Cell
+class StochasticDepth(nn.Module):
+    " Skip the residual branch of a block with probability p during training "
+    def __init__(self,
+                 p=0., # probability to skip the residual branch
+                 mode='row', # skip the branch per sample ('row') or for the whole batch ('batch')
+                ):
+        super().__init__()
+        assert 0 <= p < 1, 'p must be in range of [0,1)'
+        assert mode in ('row', 'batch'), f'Unknown stochastic depth mode {mode}'
+        self.p, self.mode = p, mode
+
+    def forward(self, x) -> Optional[torch.Tensor]:
+        " Indices of the samples in `x` for which the residual branch is computed, None if it is not skipped "
+        if not self.training or self.p == 0: return None
+        # drawn on the CPU, so selecting the samples does not need to synchronize with a GPU
+        if self.mode == 'batch': keep = torch.rand(1).expand(x.shape[0]) >= self.p
+        else: keep = torch.rand(x.shape[0]) >= self.p
+        return keep.nonzero().view(-1).to(x.device)
+
+    def add(self, shortcut, branch, keep):
+        " Add the output of the residual branch for the samples `keep`, scaled by 1 / (1 - p), to `shortcut` "
+        return shortcut.index_add(0, keep, branch, alpha=1 / (1 - self.p))
 
 # Cell
 class SqueezeExpand(nn.Module):
@@ -116,7 +200,8 @@ class MBConvBlock(nn.Module):
                  se_ratio, # squeeze-expand ratio
                  id_skip, # if skip connection shouldbe used
                  expand_ratio, # expansion ratio for inverted bottleneck
-                 drop_connect_rate = 0.2, # percentage of dropped connections
+                 drop_connect_rate = 0.2, # probability to skip the residual branch during training
+                 stochastic_depth_mode='row', # skip the residual branch per sample ('row') or for the whole batch ('batch')
                  act=nn.SiLU, # type of activation function
                  norm=nn.BatchNorm3d, # type of batch normalization
                  **kwargs # further arguments passed to `ConvLayerDynamicPadding`
@@ -130,6 +215,7 @@ class MBConvBlock(nn.Module):
             self.expand_conv = ConvLayer(in_c=in_c, out_c=n_intermed,
                                          ks = 1,norm=norm,
                                          act=act, **kwargs)
+        else: self.expand_conv = nn.Identity()
 
         # depthwise convolution phase, groups makes it depthwise
         self.depthwise_conv = ConvLayer(in_c=n_intermed, out_c=n_intermed,
@@ -142,32 +228,45 @@ class MBConvBlock(nn.Module):
         if self.has_se:
             self.squeeze_expand = SqueezeExpand(in_c=n_intermed, se_ratio=se_ratio,
                                                 act=act, norm=norm)
+        else: self.squeeze_expand = nn.Identity()
 
         # pointwise convolution phase
         self.project_conv = ConvLayer(in_c=n_intermed, out_c=out_c, ks=1,
                                       act = None, **kwargs)
 
-        self.drop_conncet = DropConnect(drop_connect_rate)
+        self.stochastic_depth = StochasticDepth(drop_connect_rate, stochastic_depth_mode)
 
     def forward(self, x):
-        if self.id_skip: inputs = x # save input only if skip connection
-
+        # skip connection and stochastic depth
+        if self.id_skip and self.stride == 1 and self.in_c == self.out_c:
+            keep = self.stochastic_depth(x)
+            if keep is None: return self.forward_residual(x) + x
+            if keep.numel() == 0: return x
+            return self.stochastic_depth.add(x, self.forward_residual(x[keep]), keep)
+        return self.forward_residual(x)
+
+    def forward_residual(self, x):
+        " Residual branch of the block "
         # expansion
-        if self.expand_ratio != 1: x = self.expand_conv(x)
+        x = self.expand_conv(x)
 
         # depthwise convolution
         x = self.depthwise_conv(x)
 
-        # squeeze and excitation (self attention)
-        if self.has_se:  x = self.squeeze_expand(x) * x
+        # squeeze and excitation (self attention), `SqueezeExpand` already multiplies its gate with `x`
+        x = self.squeeze_expand(x)
 
         # pointwise convolution
-        x = self.project_conv(x)
+        return self.project_conv(x)
 
-        # skip connection and drop connect
-        if self.id_skip and self.stride == 1 and self.in_c == self.out_c:
-            x = self.drop_conncet(x) + inputs  # skip connection
-        return x
+# Cell
+class SigmoidFloat32(nn.Sigmoid):
+    " Sigmoid, which is computed in float32 for inputs with reduced precision "
+    def forward(self, x): return torch.sigmoid(x.float())
+
+class SoftmaxFloat32(nn.Softmax):
+    " Softmax, which is computed in float32 for inputs with reduced precision "
+    def forward(self, x): return F.softmax(x.float(), self.dim)
 
 # Cell
 class SpatialAttention(nn.Module):
@@ -188,7 +287,7 @@ class SpatialAttention(nn.Module):
 
         n_final = max_pool + mean_pool + xtra_conv
         assert n_final > 0, 'No pooling layers in `SpatialAttention`-block'
-        self.out_conv = ConvLayer(n_final, 1, ks=ks, act=nn.Sigmoid, norm=None, **kwargs)
+        self.out_conv = ConvLayer(n_final, 1, ks=ks, act=SigmoidFloat32, norm=None, **kwargs)
 
 
     def forward(self, x):
@@ -196,7 +295,8 @@ class SpatialAttention(nn.Module):
         if self.max_pool: compressed.append(x.max(1)[0].unsqueeze(1))
         if self.mean_pool: compressed.append(x.mean(1).unsqueeze(1))
         if self.xtra_conv: compressed.append(self.xtra_conv_layer(x))
-        return self.out_conv(torch.cat(compressed, 1)) * x
+        # the gate is computed in float32, see `SigmoidFloat32`, and applied in the precision of `x`
+        return self.out_conv(torch.cat(compressed, 1)).to(x.dtype) * x
 
 # Cell
 class SpatialAttentionDualInput(nn.Module):
@@ -211,14 +311,26 @@ class SpatialAttentionDualInput(nn.Module):
         self.conv_s = ConvLayer(s_c, s_c, ks=2, stride=2,  act=None, norm=None, bias = False)
         self.conv_attn = nn.Sequential(
             nn.ReLU(),
-            ConvLayer(s_c, 1, ks=1,  act=nn.Sigmoid, stride=1, **kwargs),
+            ConvLayer(s_c, 1, ks=1,  act=SigmoidFloat32, stride=1, **kwargs),
         )
 
     def forward(self, up_in, s):
         x = self.conv_u(up_in)
         s = F.interpolate(self.conv_s(s), size=x.shape[2:], mode='trilinear', align_corners=False)
         attn_gate = F.interpolate(self.conv_attn(x + s), size=up_in.shape[2:], mode='trilinear', align_corners=False)
-        return up_in * attn_gate
+        # the gate is computed in float32, see `SigmoidFloat32`, and applied in the precision of `up_in`
+        return up_in * attn_gate.to(up_in.dtype)
+
+# Cell
+def resize_like(x, other):
+    " Resize `x` to the spatial size of `other` with nearest interpolation, if their sizes differ "
+    if not torch.jit.is_scripting():
+        # exported ONNX graphs have dynamic sizes, which are not known during export, and always resize
+        if torch.onnx.is_in_onnx_export(): return F.interpolate(x, other.shape[2:], mode='nearest')
+    if x.shape[2:] != other.shape[2:]: return F.interpolate(x, other.shape[2:], mode='nearest')
+    return x
+
+torch.fx.wrap('resize_like') # keep the shape dependent branch out of `torch.fx` graphs
 
 # Cell
 class UnetBlock(nn.Module):
@@ -253,9 +365,7 @@ class UnetBlock(nn.Module):
     def forward(self, up_in, s):
         s = self.bn(s)
         if hasattr(self, 'sa'): up_in = self.sa(up_in, s)
-        up_out = self.up(up_in)
-        if s.shape[-3:] != up_out.shape[-3:]:
-            up_out = F.interpolate(up_out, s.shape[-3:], mode='nearest')
+        up_out = resize_like(self.up(up_in), s)
         cat_x = torch.cat([up_out, s], dim=1)
         return self.final_conv(cat_x)
 
@@ -265,7 +375,8 @@ class ResBlock(nn.Module):
 
     @delegates(ConvLayer.__init__)
     def __init__(self, in_c, out_c, ks=3, stride=1, padding='auto', bottleneck=True,
-                 base_width=64, groups = 1, norm=nn.BatchNorm3d, act=nn.ReLU, **kwargs):
+                 base_width=64, groups = 1, norm=nn.BatchNorm3d, act=nn.ReLU, stochastic_depth=0.,
+                 stochastic_depth_mode='row', **kwargs):
         super(ResBlock, self).__init__()
 
         width = int(out_c * (base_width / 64.)) * groups
@@ -292,11 +403,29 @@ class ResBlock(nn.Module):
             self.downsample = ConvLayer(in_c, out_c, ks=1, stride=stride, norm=norm, act=None, **kwargs)
         else: self.downsample = nn.Identity()
         self.final_act = act()
+        self.stochastic_depth = StochasticDepth(stochastic_depth, stochastic_depth_mode)
 
     def forward(self, x):
-        x = self.conv(x) + self.downsample(x)
+        keep = self.stochastic_depth(x) # None, unless residual branches are skipped during training
+        if keep is None: x = self.conv(x) + self.downsample(x)
+        elif keep.numel() == 0: x = self.downsample(x)
+        else: x = self.stochastic_depth.add(self.downsample(x), self.conv(x[keep]), keep)
         return self.final_act(x)
 
+    def input_projections(self):
+        " The 1x1x1 convolutions reading the input, if the input is used by nothing else, else None "
+        if isinstance(self.downsample, nn.Identity): return None
+        conv, downsample = self.conv.conv_layer_1.input_projections(), self.downsample.input_projections()
+        if conv is None or downsample is None: return None
+        return conv + downsample
+
+    def forward_from_projections(self, x, skip):
+        " Continue the forward pass after the convolutions from `input_projections` "
+        x = self.conv.conv_layer_1.forward_from_projections(x)
+        for name, layer in self.conv.named_children():
+            if name != 'conv_layer_1': x = layer(x)
+        return self.final_act(x + self.downsample.forward_from_projections(skip))
+
 # Cell
 class DoubleConv(nn.Module):
     @delegates(ConvLayer)
@@ -316,7 +445,7 @@ class DeepSupervision(nn.Module):
         assert out_c > 1, f'Expected `out_c` to be at least 2 but got {out_c}'
         self.conv = nn.Sequential(
             ConvLayer(in_c, out_c, ks=ks, act=act, norm=norm),
-            nn.Softmax(1)
+            SoftmaxFloat32(1)
         )
 
     def forward(self, x):
@@ -0,0 +1,116 @@
+# AUTOGENERATED! DO NOT EDIT! File to edit: nbs/estimate.ipynb (unless otherwise specified).
+
+__all__ = ['conv_macs', 'conv_transpose_macs', 'linear_macs', 'MAC_COUNTERS', 'MemoryTracker', 'estimate',
+           'inference_peak_mib']
+
+# Cell
+# default_exp estimate
+import math
+import torch
+import weakref
+from torch import nn
+from itertools import chain
+from collections import OrderedDict
+from copy import deepcopy
+from torch.utils._pytree import tree_flatten
+from torch.utils._python_dispatch import TorchDispatchMode
+
+# Cell
+import sys
+sys.path.append('..')
+from .modular_unet import ModularUNet
+
+# Cell
+def conv_macs(module, inp, out):
+    " MACs of a convolution: each output voxel is a dot product over (in_channels / groups) * kernel voxels "
+    return out.numel() * module.in_channels // module.groups * math.prod(module.kernel_size)
+
+def conv_transpose_macs(module, inp, out):
+    " MACs of a transposed convolution: each input voxel is scattered to (out_channels / groups) * kernel voxels "
+    return inp[0].numel() * module.out_channels // module.groups * math.prod(module.kernel_size)
+
+def linear_macs(module, inp, out):
+    return out.numel() * module.in_features
+
+MAC_COUNTERS = {nn.Conv3d: conv_macs, nn.ConvTranspose3d: conv_transpose_macs, nn.Linear: linear_macs}
+
+# Cell
+def _mac_counter(module):
+    for cls in type(module).__mro__:
+        if cls in MAC_COUNTERS: return MAC_COUNTERS[cls]
+
+# Cell
+class MemoryTracker(TorchDispatchMode):
+    " Track the memory of all tensors created while active and alive at the same time "
+    def __init__(self):
+        super().__init__()
+        self.live, self.peak = 0, 0
+
+    def _free(self, nbytes): self.live -= nbytes
+
+    def __torch_dispatch__(self, func, types, args=(), kwargs=None):
+        out = func(*args, **(kwargs or {}))
+        if func.is_view: return out # views share memory with their base
+        inputs = {id(t) for t in tree_flatten((args, kwargs))[0] if isinstance(t, torch.Tensor)}
+        for t in tree_flatten(out)[0]:
+            if isinstance(t, torch.Tensor) and id(t) not in inputs: # skip inplace operations
+                nbytes = t.numel() * t.element_size()
+                self.live += nbytes
+                self.peak = max(self.peak, self.live)
+                weakref.finalize(t, self._free, nbytes)
+        return out
+
+# Cell
+def estimate(model_cls, # a `ModularUNet` subclass
+             in_c=1, # number of input channels
+             n_classes=2, # number of output channels
+             inp_sz=(128, 128, 128), # spatial size of the input
+             batch_size=1,
+             dtype=torch.float32, # data type of weights and activations
+             **kwargs # further arguments for `model_cls`
+            ):
+    " Estimate parameters, MACs per stage and peak activation memory of `model_cls` without allocating it "
+    with torch.device('meta'): model = model_cls(in_c, n_classes, **kwargs).to(dtype)
+    x = torch.empty(batch_size, in_c, *inp_sz, device='meta', dtype=dtype)
+
+    macs = OrderedDict() # per stage, e.g. `encoder_block_0`, in order of execution
+    def count(module, inp, out, stage, counter):
+        if not torch.is_grad_enabled(): macs[stage] = macs.get(stage, 0) + counter(module, inp, out)
+    hooks = [m.register_forward_hook(lambda m, i, o, stage=name.split('.')[0], counter=_mac_counter(m):
+                                     count(m, i, o, stage, counter))
+             for name, m in model.named_modules() if _mac_counter(m) is not None]
+
+    try:
+        # inference: tensors are freed as soon as they are not needed anymore
+        with torch.no_grad(), MemoryTracker() as inference: model.eval()(x)
+        # training: activations needed for backward stay alive until the end of the forward pass
+        with MemoryTracker() as training: model.train()(x)
+    finally:
+        for hook in hooks: hook.remove()
+
+    n_params = sum(p.numel() for p in model.parameters())
+    return {'n_params': n_params,
+            'param_mib': sum(p.numel() * p.element_size() for p in model.parameters()) / 2**20,
+            'macs': macs,
+            'total_macs': sum(macs.values()),
+            'inference_peak_mib': inference.peak / 2**20,
+            'training_peak_mib': training.peak / 2**20}
+
+# Cell
+@torch.no_grad()
+def inference_peak_mib(model, # an existing model, in the mode it is used in
+                       inp_shape, # shape of the input, including batch and channel dimension
+                      ):
+    " Peak activation memory of a forward pass of `model` with an input of `inp_shape`, without running it "
+    precision = getattr(model, 'precision', None)
+    dtype = getattr(torch, precision) if precision else torch.float32
+    # the copy shares nothing with `model`, which can be used by other threads in the meantime
+    memo = {}
+    for t in chain(model.parameters(), model.buffers()):
+        meta = torch.empty_like(t, device='meta', dtype=dtype if t.is_floating_point() else t.dtype)
+        memo[id(t)] = nn.Parameter(meta, t.requires_grad) if isinstance(t, nn.Parameter) else meta
+    meta_model = deepcopy(model, memo) # parameters and buffers are taken from `memo` and not copied
+    if precision: meta_model.precision = None
+    x = torch.empty(inp_shape, device='meta', dtype=dtype)
+    with MemoryTracker() as tracker: meta_model(x)
+    return tracker.peak / 2**20
\ No newline at end of file
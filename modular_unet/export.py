@@ -0,0 +1,86 @@
+# AUTOGENERATED! DO NOT EDIT! File to edit: nbs/export.ipynb (unless otherwise specified).
+
+__all__ = ['export_onnx', 'OnnxPredictor', 'save_checkpoint', 'empty_model', 'load_checkpoint']
+
+# Cell
+# default_exp export
+import inspect
+import torch
+from torch import nn
+
+# Cell
+import sys
+sys.path.append('..')
+from .modular_unet import ModularUNet
+from .optimize import StaticUNet
+
+# Cell
+def _onnx_export_kwargs():
+    # newer PyTorch versions export with `torch.export` by default, which specializes on the example shape
+    return {'dynamo': False} if 'dynamo' in inspect.signature(torch.onnx.export).parameters else {}
+
+def export_onnx(model:ModularUNet,
+                fname, # file to save the ONNX graph to
+                inp_sz=(64, 64, 64), # spatial size of the example input used for tracing
+                opset_version=17
+               ):
+    " Export `model` to an ONNX graph with dynamic batch and spatial axes "
+    import onnx # optional dependency
+    x = torch.randn(2, model.in_c, *inp_sz)
+    axes = {0: 'batch', 2: 'depth', 3: 'height', 4: 'width'}
+    training = model.training
+    try:
+        with torch.no_grad():
+            torch.onnx.export(StaticUNet(model).eval(), (x, ), str(fname), input_names=['input'],
+                              output_names=['output'], dynamic_axes={'input': axes, 'output': axes},
+                              opset_version=opset_version, **_onnx_export_kwargs())
+    finally: model.train(training) # `StaticUNet` shares the blocks of `model`
+    graph = onnx.load(str(fname))
+    meta = {'in_c': model.in_c, 'n_classes': model.n_classes, 'downsampling_factor': list(model.downsampling_factor)}
+    onnx.helper.set_model_props(graph, {k: str(v) for k, v in meta.items()})
+    onnx.save(graph, str(fname))
+    return fname
+
+# Cell
+class OnnxPredictor():
+    " Run an exported model with ONNX Runtime on CPU "
+    def __init__(self,
+                 fname, # ONNX graph saved by `export_onnx`
+                 n_threads=None, # number of intra-op threads, defaults to ONNX Runtime's choice
+                ):
+        import onnxruntime as ort # optional dependency
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if n_threads: options.intra_op_num_threads = n_threads
+        self.session = ort.InferenceSession(str(fname), options, providers=['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+        meta = self.session.get_modelmeta().custom_metadata_map
+        self.in_c, self.n_classes = int(meta['in_c']), int(meta['n_classes'])
+        self.downsampling_factor = tuple(int(f) for f in meta['downsampling_factor'].strip('[]').split(','))
+
+    def __call__(self, x):
+        " Predict a batch `x` with shape (batch_size, in_c, *spatial_dims) "
+        import numpy as np # installed with onnxruntime
+        x = np.ascontiguousarray(x.detach().cpu().numpy() if isinstance(x, torch.Tensor) else x, dtype=np.float32)
+        return torch.from_numpy(self.session.run(None, {self.input_name: x})[0])
+
+# Cell
+def save_checkpoint(model:nn.Module, fname):
+    " Save the weights of `model` so `load_checkpoint` can memory-map them "
+    torch.save(model.state_dict(), str(fname)) # the zip format of `torch.save` can be memory-mapped
+    return fname
+
+def empty_model(model_cls, *args, **kwargs):
+    " Build `model_cls(*args, **kwargs)` on the meta device without allocating or initializing any weights "
+    with torch.device('meta'): return model_cls(*args, **kwargs)
+
+def load_checkpoint(model_cls, # a `ModularUNet` subclass
+                    fname, # weights saved by `save_checkpoint` or `torch.save(model.state_dict())`
+                    *args, # arguments for `model_cls`
+                    mmap=True, # memory-map the weights instead of reading them into memory
+                    **kwargs # further arguments for `model_cls`
+                   ):
+    " Build `model_cls` without initialization and load the weights in `fname` directly into its parameters "
+    model = empty_model(model_cls, *args, **kwargs)
+    model.load_state_dict(torch.load(str(fname), map_location='cpu', mmap=mmap, weights_only=True), assign=True)
+    return model
\ No newline at end of file
@@ -0,0 +1,619 @@
+# AUTOGENERATED! DO NOT EDIT! File to edit: nbs/inference.ipynb (unless otherwise specified).
+
+__all__ = ['valid_tile_size', 'tile_starts', 'gaussian_weight_map', 'PredictionAccumulator', 'ACCUMULATOR_DTYPES',
+           'SlidingWindowPredictor', 'ProcessPoolPredictor', 'open_volume', 'StreamingPredictor', 'apply_tta',
+           'invert_tta', 'tta_transforms', 'TTAPredictor', 'TileSelector', 'bounding_box', 'merge_boxes',
+           'CascadePredictor']
+
+# Cell
+# default_exp inference
+import copy
+import math
+import torch
+from torch import nn
+from torch.nn import functional as F
+import mmap
+import time
+import queue
+import numpy as np
+from itertools import product, combinations
+from concurrent.futures import ThreadPoolExecutor
+from torch import multiprocessing as mp
+
+from fastcore.basics import store_attr
+
+# Cell
+import sys
+sys.path.append('..')
+from .modular_unet import ModularUNet
+from .estimate import inference_peak_mib
+
+# Cell
+def valid_tile_size(tile_size, factor):
+    " Round each dimension of `tile_size` down to the next multiple of `factor`, but at least to `factor` "
+    if isinstance(tile_size, int): tile_size = (tile_size, )*3
+    if isinstance(factor, int): factor = (factor, )*3
+    return tuple(max(f, ts // f * f) for ts, f in zip(tile_size, factor))
+
+# Cell
+def tile_starts(size, tile, step):
+    " Start positions of tiles along one axis. The last tile is aligned to the end of the axis "
+    if size <= tile: return [0]
+    n_tiles = math.ceil((size - tile) / step) + 1
+    starts = [i * step for i in range(n_tiles - 1)]
+    return starts + [size - tile]
+
+# Cell
+def gaussian_weight_map(tile_size, sigma_scale=0.125, min_weight=1e-3):
+    " Gaussian importance map, down-weighting the borders of a tile where predictions are less reliable "
+    axes = [torch.arange(ts, dtype=torch.float32) - (ts - 1) / 2 for ts in tile_size]
+    axes = [torch.exp(-0.5 * (ax / (ts * sigma_scale)) ** 2) for ax, ts in zip(axes, tile_size)]
+    weight = axes[0][:, None, None] * axes[1][None, :, None] * axes[2][None, None, :]
+    return (weight / weight.max()).clamp_(min=min_weight)
+
+# Cell
+ACCUMULATOR_DTYPES = ('float32', 'float16', 'uint8', 'uint16')
+
+def _one_hot(n_classes, cls, probabilities=False):
+    " Prediction of class `cls` with full confidence, as one-hot `probabilities` or as logits whose softmax is one-hot up to float32 precision "
+    if probabilities: return F.one_hot(torch.tensor(cls), n_classes).float()
+    out = torch.full((n_classes, ), math.log(torch.finfo(torch.float32).eps))
+    out[cls] = 0.
+    return out
+
+class PredictionAccumulator():
+    " Weighted average of overlapping predictions, stored as float32, float16 or quantized probabilities "
+    def __init__(self,
+                 n_classes, # number of channels of the predictions
+                 shape, # spatial shape of the volume
+                 dtype='float32', # storage of the predictions, one of `ACCUMULATOR_DTYPES`
+                 probabilities=False, # predictions are probabilities, e.g. after softmax or from `DeepSupervision`. Required for 'uint8' and 'uint16'
+                ):
+        assert dtype in ACCUMULATOR_DTYPES, f'Unknown dtype {dtype}'
+        self.quantized, self.probabilities = dtype.startswith('uint'), probabilities
+        assert probabilities or not self.quantized, f'{dtype} can only store probabilities'
+        self.scale = float(torch.iinfo(getattr(torch, dtype)).max) if self.quantized else 1.
+        self.values = torch.zeros(n_classes, *shape, dtype=getattr(torch, dtype))
+        self.weights = torch.zeros(shape, dtype=torch.float32 if dtype == 'float32' else torch.float16)
+
+    @property
+    def nbytes(self): return self.values.nbytes + self.weights.nbytes
+
+    def add(self, region, pred, weight=1.):
+        " Add `pred` with shape (n_classes, *spatial_dims) to `region`, a tuple of spatial slices, weighted by `weight` "
+        region = tuple(region)
+        idx = (slice(None), ) + region
+        weight = torch.as_tensor(weight, dtype=torch.float32)
+        total = self.weights[region].float() + weight
+        if self.quantized: # update the running average
+            mean = self.values[idx].float().mul_(total - weight).add_(pred.clamp(0, 1) * weight * self.scale).div_(total)
+            self.values[idx] = mean.round_().to(self.values.dtype)
+        else: self.values[idx] += (pred * weight).to(self.values.dtype)
+        self.weights[region] = total.to(self.weights.dtype)
+
+    def average(self, region=(), fill=None):
+        " Weighted average of the predictions in `region` as float32. Probabilities are renormalized to sum to one "
+        region = tuple(region)
+        values = self.values[(slice(None), ) + region].float()
+        out = values / self.scale if self.quantized else values / self.weights[region].float()
+        if self.probabilities: out.div_(out.sum(0, keepdim=True).clamp_(min=1e-12))
+        if fill is not None: # class `fill` where nothing was added, on the same scale as the other predictions
+            empty = self.weights[region] == 0
+            out[:, empty] = _one_hot(out.shape[0], fill, self.probabilities)[:, None]
+        return out
+
+    def labels(self, region=(), chunk=16, fill=None):
+        " Class with the highest average prediction in `region` as uint8, computed for `chunk` rows at a time "
+        region = tuple(region)
+        values = self.values[(slice(None), ) + region]
+        out = torch.empty(values.shape[1:], dtype=torch.uint8 if values.shape[0] <= 256 else torch.int32)
+        for i in range(0, values.shape[1], chunk): out[i:i+chunk] = values[:, i:i+chunk].float().argmax(0)
+        if fill is not None: out[self.weights[region] == 0] = fill # class `fill` where nothing was added
+        return out
+
+    def shift(self, n):
+        " Drop the first `n` rows along the first spatial axis and append `n` empty rows "
+        self.values, self.weights = self.values.roll(-n, 1), self.weights.roll(-n, 0)
+        self.values[:, -n:], self.weights[-n:] = 0, 0
+
+# Cell
+class SlidingWindowPredictor():
+    " Predict a volume with a `ModularUNet` on overlapping tiles and blend the predictions "
+    def __init__(self,
+                 model:ModularUNet, # a trained `ModularUNet` subclass or a callable with `n_classes` and `downsampling_factor`, e.g. `OnnxPredictor`
+                 tile_size=(96, 96, 96), # size of each tile, rounded down to a multiple of `model.downsampling_factor`
+                 overlap=0.5, # overlap of neighbouring tiles as fraction of the tile size
+                 batch_size=4, # number of tiles per forward pass
+                 blend='gaussian', # how to weight overlapping tiles, either 'gaussian' or 'constant'
+                 sigma_scale=0.125, # standard deviation of the gaussian weight map relative to the tile size
+                 pad_value=0., # value to pad volumes smaller than `tile_size` with
+                 average='logits', # blend 'logits' or 'probabilities'
+                 probabilities=False, # `model` outputs probabilities, e.g. with a `DeepSupervision` head, which are blended without another softmax
+                 dtype='float32', # storage of the blended predictions, see `PredictionAccumulator`
+                 selector=None, # a `TileSelector` to skip tiles without foreground
+                 background=0, # class of the voxels which are only covered by skipped tiles
+                ):
+        store_attr()
+        assert 0 <= overlap < 1, 'overlap must be in range of [0, 1)'
+        assert blend in ('gaussian', 'constant'), f'Unknown blend mode {blend}'
+        assert average in ('logits', 'probabilities'), f'Unknown average mode {average}'
+        self.tile_size = valid_tile_size(tile_size, model.downsampling_factor)
+        self.n_classes, self.downsampling_factor = model.n_classes, model.downsampling_factor
+        if blend == 'gaussian': self.weight_map = gaussian_weight_map(self.tile_size, sigma_scale)
+        else: self.weight_map = torch.ones(self.tile_size)
+        self.fill = None if selector is None else background
+        self.stats = {'n_tiles': 0, 'n_skipped': 0, 'predict_s': 0., 'select_s': 0.}
+
+    def tiles(self, size):
+        " Slices of all tiles covering a volume of `size` "
+        steps = [max(1, int(ts * (1 - self.overlap))) for ts in self.tile_size]
+        starts = [tile_starts(sz, ts, st) for sz, ts, st in zip(size, self.tile_size, steps)]
+        return [tuple(slice(s, s + ts) for s, ts in zip(start, self.tile_size)) for start in product(*starts)]
+
+    def predict_tiles(self, tiles):
+        " Run the model on a batch of tiles "
+        device = next(self.model.parameters()).device if isinstance(self.model, nn.Module) else tiles.device
+        return self.model(tiles.to(device)).to(tiles.device, torch.float32)
+
+    @torch.no_grad()
+    def __call__(self, x):
+        " Predict `x` with shape (batch_size, channels, *spatial_dims) tile by tile "
+        return self.predict(x, 'average')
+
+    @torch.no_grad()
+    def labels(self, x):
+        " Predict the labels of `x` with shape (batch_size, channels, *spatial_dims), without a float32 map of all classes "
+        return self.predict(x, 'labels')
+
+    def predict(self, x, output):
+        " Pad `x` to the tile size, predict it and return the 'average' or the 'labels' of each volume "
+        sz, masks = x.shape[-3:], None
+        pad = [max(0, ts - s) for s, ts in zip(sz, self.tile_size)]
+        if any(pad):
+            pad = [v for p in pad[::-1] for v in (0, p)]
+            if self.selector is not None: masks = self.padded_masks(x, pad)
+            x = F.pad(x, pad, value=self.pad_value)
+        out = torch.stack([getattr(acc, output)(fill=self.fill) for acc in self.accumulate_volumes(x, masks)])
+        return out[..., :sz[0], :sz[1], :sz[2]]
+
+    def padded_masks(self, x, pad):
+        " Foreground masks of the volumes in `x` padded by `pad`, see `F.pad`. The padding is never foreground "
+        start = time.perf_counter()
+        masks = [self.selector.mask(v) for v in F.pad(x.float(), pad, value=-math.inf)]
+        self.stats['select_s'] += time.perf_counter() - start
+        return masks
+
+    def accumulator(self, shape):
+        " An empty `PredictionAccumulator` for a volume of `shape` "
+        return PredictionAccumulator(self.model.n_classes, shape, self.dtype, self.average == 'probabilities' or self.probabilities)
+
+    def accumulate_volumes(self, xs, masks=None):
+        " Predict volumes with shape (channels, *spatial_dims) one after another. `masks` are passed to `select_tiles` "
+        return [self.accumulate_volume(x, mask) for x, mask in zip(xs, masks or [None] * len(xs))]
+
+    def accumulate_volume(self, x, mask=None):
+        " Predict a single volume with shape (channels, *spatial_dims) into a `PredictionAccumulator` "
+        acc = self.accumulator(x.shape[-3:])
+        self.accumulate(x, acc, mask)
+        return acc
+
+    def predict_volume(self, x):
+        " Predict a single volume with shape (channels, *spatial_dims) "
+        return self.accumulate_volume(x).average(fill=self.fill)
+
+    def select_tiles(self, x, mask=None):
+        " Tiles of `x` to predict, without the tiles `selector` skips. `mask` is the foreground mask of `x`, computed by `selector` if not given "
+        tiles, start = self.tiles(x.shape[-3:]), time.perf_counter()
+        if self.selector is None: selected = tiles
+        else: selected = self.selector.select(tiles, self.selector.mask(x) if mask is None else mask)
+        self.stats['select_s'] += time.perf_counter() - start
+        self.stats['n_tiles'] += len(tiles)
+        self.stats['n_skipped'] += len(tiles) - len(selected)
+        return selected
+
+    def skip_report(self):
+        " Number and fraction of skipped tiles and the time they would have taken less the time to select the tiles, over all calls "
+        n_predicted = self.stats['n_tiles'] - self.stats['n_skipped']
+        skipped_s = self.stats['n_skipped'] * self.stats['predict_s'] / max(1, n_predicted)
+        return {**self.stats, 'skipped_fraction': self.stats['n_skipped'] / max(1, self.stats['n_tiles']),
+                'saved_s': skipped_s - self.stats['select_s']}
+
+    def accumulate(self, x, acc, mask=None):
+        " Predict all tiles of `x` and add them to the `PredictionAccumulator` `acc`. `mask` is passed to `select_tiles` "
+        tiles = self.select_tiles(x, mask)
+        start = time.perf_counter()
+        for i in range(0, len(tiles), self.batch_size):
+            batch = tiles[i:i+self.batch_size]
+            self.add_tiles(acc, batch, self.predict_tiles(torch.stack([x[(slice(None), ) + t] for t in batch])))
+        self.stats['predict_s'] += time.perf_counter() - start
+
+    def add_tiles(self, acc, tiles, pred):
+        " Add the predictions `pred` of `tiles` to `acc`, weighted by the weight map "
+        if self.average == 'probabilities' and not self.probabilities: pred = pred.softmax(1)
+        for t, p in zip(tiles, pred): acc.add(t, p, self.weight_map)
+
+# Cell
+def _pool_worker(model, slot, tasks, results, ack, rank, n_threads):
+    " Predict batches of tiles from `tasks` and write the predictions into the shared `slot` "
+    torch.set_num_threads(n_threads)
+    while True:
+        task = tasks.get()
+        if task is None: return
+        k, x, tiles = task
+        try:
+            with torch.no_grad(): slot[:len(tiles)] = model(torch.stack([x[(slice(None), ) + t] for t in tiles]))
+        except Exception as e:
+            results.put((rank, k, repr(e)))
+            return
+        results.put((rank, k, None))
+        ack.get() # wait until the main process has read `slot`
+
+# Cell
+class ProcessPoolPredictor(SlidingWindowPredictor):
+    " `SlidingWindowPredictor` which predicts the tiles on worker processes sharing the weights of `model` "
+    def __init__(self,
+                 model:ModularUNet, # a trained `ModularUNet` subclass, the workers share a copy of its weights
+                 tile_size=(96, 96, 96), # size of each tile, rounded down to a multiple of `model.downsampling_factor`
+                 overlap=0.5, # overlap of neighbouring tiles as fraction of the tile size
+                 batch_size=1, # number of tiles per forward pass of a worker
+                 n_workers=2, # number of worker processes
+                 n_threads=1, # intra-op threads of each worker
+                 start_method='spawn', # how workers are started, 'fork' is faster but unsafe if the parent process uses several threads
+                 **kwargs # further arguments for `SlidingWindowPredictor`
+                ):
+        super().__init__(model, tile_size, overlap, batch_size, **kwargs)
+        store_attr('n_workers,n_threads,start_method')
+        ctx = mp.get_context(start_method)
+        self.shared_model = copy.deepcopy(model).share_memory() # the parameters of `model` stay where they are
+        self.tasks, self.results = ctx.Queue(), ctx.Queue()
+        self.slots = [torch.empty(batch_size, model.n_classes, *self.tile_size).share_memory_() for _ in range(n_workers)]
+        self.acks = [ctx.SimpleQueue() for _ in range(n_workers)]
+        self.workers = [ctx.Process(target=_pool_worker, args=(self.shared_model, slot, self.tasks, self.results, ack, rank, n_threads),
+                                    daemon=True) for rank, (slot, ack) in enumerate(zip(self.slots, self.acks))]
+        for w in self.workers: w.start()
+
+    def accumulate_volumes(self, xs, masks=None):
+        " Predict volumes with shape (channels, *spatial_dims), spreading the tiles of all volumes across the workers "
+        xs = [torch.empty_like(x, dtype=torch.float32).share_memory_().copy_(x) for x in xs]
+        tasks = []
+        for i, (x, mask) in enumerate(zip(xs, masks or [None] * len(xs))):
+            tiles = self.select_tiles(x, mask)
+            tasks += [(i, tiles[j:j+self.batch_size]) for j in range(0, len(tiles), self.batch_size)]
+        start = time.perf_counter()
+        for k, (i, tiles) in enumerate(tasks): self.tasks.put((k, xs[i], tiles))
+        accs = [self.accumulator(x.shape[-3:]) for x in xs]
+        for _ in tasks:
+            rank, k, error = self._next_result()
+            if error is not None:
+                self.terminate()
+                raise RuntimeError(f'Worker {rank} failed: {error}')
+            i, tiles = tasks[k]
+            self.add_tiles(accs[i], tiles, self.slots[rank][:len(tiles)])
+            self.acks[rank].put(None)
+        self.stats['predict_s'] += time.perf_counter() - start
+        return accs
+
+    def accumulate_volume(self, x, mask=None):
+        " Predict a single volume with shape (channels, *spatial_dims) into a `PredictionAccumulator` "
+        return self.accumulate_volumes([x], [mask])[0]
+
+    def _next_result(self):
+        " Wait for the next finished batch, but fail if a worker died "
+        while True:
+            try: return self.results.get(timeout=1)
+            except queue.Empty:
+                dead = [rank for rank, w in enumerate(self.workers) if not w.is_alive()]
+                if dead:
+                    self.terminate()
+                    raise RuntimeError(f'Worker {dead[0]} died')
+
+    def close(self):
+        " Stop the workers once they are idle "
+        for _ in self.workers: self.tasks.put(None)
+        for w in self.workers: w.join()
+
+    def terminate(self):
+        " Stop the workers immediately "
+        for w in self.workers: w.terminate()
+
+    def __enter__(self): return self
+    def __exit__(self, *args): self.close()
+
+# Cell
+def open_volume(fname, # `.npy` file or raw volume
+                shape=None, # shape of a raw volume, e.g. (channels, depth, height, width)
+                dtype=np.float32, # data type of a raw volume
+                mode='r' # 'r' to read or 'r+' to also write
+               ):
+    " Memory-map a `.npy` file or a raw volume without reading it "
+    if str(fname).endswith('.npy'): return np.load(str(fname), mmap_mode=mode)
+    return np.memmap(str(fname), dtype=dtype, mode=mode, shape=shape)
+
+def _release_pages(arr, start, stop):
+    " Drop rows `start:stop` of the second axis of a memory-mapped `arr` from memory. Written pages are kept in the file "
+    if arr.ndim == 3: arr = arr[None] # labels without a channel axis
+    mm = getattr(arr, '_mmap', None)
+    if mm is None or not hasattr(mm, 'madvise') or not arr.flags.c_contiguous: return
+    offset = arr.ctypes.data - np.frombuffer(mm, np.uint8).ctypes.data # offset of `arr` in the mapping
+    row = arr[0, 0].nbytes
+    for c in range(arr.shape[0]):
+        lo = offset + (c * arr.shape[1] + start) * row
+        hi = offset + (c * arr.shape[1] + stop) * row
+        lo, hi = -(-lo // mmap.PAGESIZE) * mmap.PAGESIZE, hi // mmap.PAGESIZE * mmap.PAGESIZE # only whole pages
+        if hi > lo: mm.madvise(mmap.MADV_DONTNEED, lo, hi - lo)
+
+# Cell
+class StreamingPredictor(SlidingWindowPredictor):
+    " Predict a volume larger than memory slab by slab, from a memory-mapped input into a memory-mapped output "
+    def __init__(self,
+                 model:ModularUNet, # a trained `ModularUNet` subclass or a callable with `n_classes` and `downsampling_factor`
+                 tile_size=(96, 96, 96), # size of each tile, rounded down to a multiple of `model.downsampling_factor`
+                 overlap=0.5, # overlap of neighbouring tiles as fraction of the tile size
+                 batch_size=4, # number of tiles per forward pass
+                 prefetch=True, # read the next slab on a background thread while the current one is predicted
+                 **kwargs # further arguments for `SlidingWindowPredictor`
+                ):
+        super().__init__(model, tile_size, overlap, batch_size, **kwargs)
+        self.prefetch = prefetch
+
+    def slab_starts(self, depth):
+        " Start of each slab along the first spatial axis "
+        return tile_starts(depth, self.tile_size[0], max(1, int(self.tile_size[0] * (1 - self.overlap))))
+
+    def read_slab(self, x, start):
+        " Read the slab at `start` of `x` with shape (channels, *spatial_dims) into a tensor, padded to the tile size "
+        slab = torch.from_numpy(np.array(x[:, start:start + self.tile_size[0]], dtype=np.float32))
+        pad = [max(0, ts - s) for s, ts in zip(slab.shape[-3:], self.tile_size)]
+        if any(pad): slab = F.pad(slab, [v for p in pad[::-1] for v in (0, p)], value=self.pad_value)
+        return slab
+
+    def slab_mask(self, x, slab, start):
+        " Foreground mask of `slab`, read at `start` of `x`, computed with `selector.margin` more rows of `x` on each side "
+        begin, ds = time.perf_counter(), self.selector.downsampling
+        n = math.ceil(self.selector.margin / ds) * ds # rows of context, a multiple of the downsampling
+        lo = max(0, start - n)
+        context = torch.from_numpy(np.array(x[:, lo:start + slab.shape[1] + n], dtype=np.float32))
+        # pad to the shape of `slab` with `n` rows on each side. Rows and padding outside of `x` are never foreground
+        front = n - (start - lo)
+        back = 2 * n + slab.shape[1] - front - context.shape[1]
+        pad = (0, slab.shape[-1] - context.shape[-1], 0, slab.shape[-2] - context.shape[-2], front, back)
+        mask = self.selector.mask(F.pad(context, pad, value=-math.inf))
+        self.stats['select_s'] += time.perf_counter() - begin
+        return mask[n // ds:n // ds - (-slab.shape[1] // ds)]
+
+    @torch.no_grad()
+    def predict_array(self,
+                      x, # array with shape (channels, *spatial_dims), e.g. from `open_volume`
+                      out, # array with shape (n_classes, *spatial_dims) for the 'average' or (*spatial_dims) for the 'labels'
+                      output='average' # write the 'average' prediction or the 'labels'
+                     ):
+        " Predict `x` slab by slab into `out` "
+        d, h, w = x.shape[-3:]
+        starts = self.slab_starts(d)
+        acc = self.accumulator((self.tile_size[0], max(h, self.tile_size[1]), max(w, self.tile_size[2])))
+        with ThreadPoolExecutor(1) as pool:
+            slab = pool.submit(self.read_slab, x, starts[0])
+            for i, start in enumerate(starts):
+                xs, last = slab.result(), i + 1 == len(starts)
+                if self.prefetch and not last: slab = pool.submit(self.read_slab, x, starts[i + 1])
+                self.accumulate(xs, acc, None if self.selector is None else self.slab_mask(x, xs, start))
+                if not self.prefetch and not last: slab = pool.submit(self.read_slab, x, starts[i + 1])
+                n = (d if last else starts[i + 1]) - start # rows which no later slab overlaps
+                region = (slice(0, n), slice(0, h), slice(0, w))
+                if output == 'labels': out[start:start + n] = acc.labels(region, fill=self.fill).numpy()
+                else: out[:, start:start + n] = acc.average(region, fill=self.fill).numpy()
+                acc.shift(n)
+                _release_pages(x, start, start + n)
+                _release_pages(out, start, start + n)
+        return out
+
+    def predict_file(self,
+                     src, # `.npy` file or raw volume with shape (channels, *spatial_dims) or (*spatial_dims)
+                     dst, # `.npy` file to write the prediction to
+                     shape=None, # shape of a raw volume
+                     dtype=np.float32, # data type of a raw volume
+                     output='average' # save the 'average' prediction with shape (n_classes, *spatial_dims) or the 'labels' as uint8
+                    ):
+        " Predict the volume in `src` into a new `.npy` file `dst` "
+        x = open_volume(src, shape, dtype)
+        if x.ndim == 3: x = x[None]
+        if output == 'labels': out_dtype, out_shape = (np.uint8 if self.model.n_classes <= 256 else np.int32), x.shape[-3:]
+        else: out_dtype, out_shape = np.float32, (self.model.n_classes, *x.shape[-3:])
+        out = np.lib.format.open_memmap(str(dst), mode='w+', dtype=out_dtype, shape=out_shape)
+        self.predict_array(x, out, output)
+        out.flush()
+        return dst
+
+# Cell
+def apply_tta(x, t):
+    " Apply transform `t` = (flip_dims, k) to the spatial dimensions of `x` "
+    dims, k = t
+    if dims: x = x.flip(dims)
+    return torch.rot90(x, k, (-2, -1)) if k else x
+
+def invert_tta(x, t):
+    " Undo transform `t` = (flip_dims, k), e.g. on a prediction of an augmented view "
+    dims, k = t
+    if k: x = torch.rot90(x, -k, (-2, -1))
+    return x.flip(dims) if dims else x
+
+# Cell
+def tta_transforms(flip_dims=(-3, -2, -1), # spatial dimensions to flip
+                   rotate=True, # also rotate by multiples of 90° in the plane of the last two dimensions
+                  ):
+    " All distinct combinations of flips and in-plane rotations, starting with the identity "
+    probe, seen, transforms = torch.arange(27).view(3, 3, 3), [], []
+    for k in ((0, 2, 1, 3) if rotate else (0, )): # rotations which keep the shape first
+        for n in range(len(flip_dims) + 1):
+            for dims in combinations(flip_dims, n):
+                view = apply_tta(probe, (dims, k))
+                if any(torch.equal(view, s) for s in seen): continue
+                seen.append(view)
+                transforms.append((dims, k))
+    return transforms
+
+# Cell
+class TTAPredictor():
+    " Average the predictions of `model` for flipped and rotated views of the input "
+    def __init__(self,
+                 model:ModularUNet, # a trained `ModularUNet` subclass or a callable with `n_classes` and `downsampling_factor`
+                 transforms=None, # list of (flip_dims, k) tuples, defaults to `tta_transforms()`
+                 average='logits', # average 'logits' or 'probabilities'
+                 probabilities=False, # `model` outputs probabilities, e.g. with a `DeepSupervision` head, which are averaged without another softmax
+                 memory_mib=2048, # memory budget for the activations of one forward pass
+                 batch_size=None, # fixed number of views per forward pass, overrides `memory_mib`
+                 dtype='float32', # storage of the averaged predictions, see `PredictionAccumulator`
+                ):
+        store_attr()
+        assert average in ('logits', 'probabilities'), f'Unknown average mode {average}'
+        if transforms is None: self.transforms = tta_transforms()
+        self.n_classes, self.downsampling_factor = model.n_classes, model.downsampling_factor
+        self.n_views = {} # views per batch, by view shape
+
+    def views_per_batch(self, shape):
+        " Number of views of `shape` which fit into `memory_mib` "
+        if self.batch_size is not None: return self.batch_size
+        if not isinstance(self.model, nn.Module): return 1
+        shape = tuple(shape)
+        if shape not in self.n_views:
+            view_mib = inference_peak_mib(self.model, (1, *shape)) + math.prod(shape) * 4 / 2**20
+            self.n_views[shape] = max(1, int(self.memory_mib // view_mib))
+        return self.n_views[shape]
+
+    def batches(self, shape):
+        " Transforms grouped by the shape of the view they create and split into batches "
+        groups = {}
+        for t in self.transforms: groups.setdefault(t[1] % 2, []).append(t)
+        for k, group in groups.items():
+            view_shape = (*shape[:-2], *shape[-2:][::-1]) if k else shape
+            n = self.views_per_batch(view_shape)
+            for i in range(0, len(group), n): yield group[i:i+n]
+
+    def predict_views(self, views):
+        " Run the model on a batch of views "
+        device = next(self.model.parameters()).device if isinstance(self.model, nn.Module) else views.device
+        pred = self.model(views.to(device)).to(views.device, torch.float32)
+        return pred.softmax(1) if self.average == 'probabilities' and not self.probabilities else pred
+
+    @torch.no_grad()
+    def __call__(self, x):
+        " Predict `x` with shape (batch_size, channels, *spatial_dims) "
+        return torch.stack([self.predict_volume(volume) for volume in x])
+
+    def predict_volume(self, x):
+        " Predict a single volume with shape (channels, *spatial_dims) "
+        acc = PredictionAccumulator(self.n_classes, x.shape[-3:], self.dtype, self.average == 'probabilities' or self.probabilities)
+        for batch in self.batches(x.shape):
+            pred = self.predict_views(torch.stack([apply_tta(x, t) for t in batch]))
+            for t, p in zip(batch, pred): acc.add((), invert_tta(p, t))
+        return acc.average()
+
+# Cell
+class TileSelector():
+    " Select the tiles with foreground, found by an intensity threshold on a downsampled volume "
+    def __init__(self,
+                 threshold, # voxels above `threshold` in any channel are foreground, e.g. -500 to skip air in CT
+                 downsampling=4, # the volume is max-pooled by this factor before thresholding
+                 margin=16, # safety margin in voxels around the foreground, tiles within this distance are never skipped
+                ):
+        store_attr()
+
+    def mask(self, x):
+        " Foreground mask of `x` with shape (channels, *spatial_dims), downsampled by `downsampling` "
+        x = x.float().amax(0)[None, None]
+        mask = F.max_pool3d(x, self.downsampling, ceil_mode=True) > self.threshold
+        m = math.ceil(self.margin / self.downsampling)
+        if m: mask = F.max_pool3d(mask.float(), 2 * m + 1, stride=1, padding=m) > 0
+        return mask[0, 0]
+
+    def select(self, tiles, mask):
+        " The `tiles` which overlap the foreground in `mask` "
+        ds = self.downsampling
+        return [t for t in tiles if mask[tuple(slice(s.start // ds, -(-s.stop // ds)) for s in t)].any()]
+
+# Cell
+def bounding_box(mask):
+    " Slices of the smallest box containing all foreground voxels of `mask`, or `None` if there are none "
+    if not mask.any(): return None
+    idx = mask.nonzero()
+    return tuple(slice(int(lo), int(hi) + 1) for lo, hi in zip(idx.min(0).values, idx.max(0).values))
+
+def merge_boxes(boxes):
+    " Merge overlapping boxes into their bounding box until no boxes overlap "
+    boxes = list(boxes)
+    for i, j in combinations(range(len(boxes)), 2):
+        if all(a.start < b.stop and b.start < a.stop for a, b in zip(boxes[i], boxes[j])):
+            merged = tuple(slice(min(a.start, b.start), max(a.stop, b.stop)) for a, b in zip(boxes[i], boxes[j]))
+            return merge_boxes([merged] + [box for k, box in enumerate(boxes) if k not in (i, j)])
+    return boxes
+
+# Cell
+class CascadePredictor():
+    " Find regions of interest at a low resolution and predict only their bounding boxes at full resolution "
+    def __init__(self,
+                 model:ModularUNet, # full resolution model or a predictor with `n_classes` and `downsampling_factor`, e.g. `SlidingWindowPredictor`
+                 coarse_model=None, # model or predictor for the low resolution pass, defaults to `model`
+                 scale=0.25, # the volume is resized by this factor for the low resolution pass
+                 classes=None, # classes which make up the regions of interest, defaults to all but `background`
+                 margin=16, # margin in voxels around each bounding box at full resolution
+                 background=0, # class outside of the regions of interest
+                 probabilities=False, # `model` predicts probabilities instead of logits, e.g. a predictor with `average='probabilities'`
+                ):
+        store_attr()
+        if coarse_model is None: self.coarse_model = model
+        self.n_classes, self.downsampling_factor = model.n_classes, model.downsampling_factor
+        if classes is None: self.classes = [c for c in range(model.n_classes) if c != background]
+
+    def predict(self, model, x):
+        " Run `model` on a batch `x` "
+        param = next(model.parameters(), None) if isinstance(model, nn.Module) else None
+        return model(x if param is None else x.to(param.device)).to(x.device, torch.float32)
+
+    def coarse_size(self, size):
+        " Spatial size of the low resolution volume, a multiple of the downsampling factor of `coarse_model` "
+        factor = getattr(self.coarse_model, 'downsampling_factor', (1, 1, 1))
+        return [max(f, round(s * self.scale / f) * f) for s, f in zip(size, factor)]
+
+    def regions(self, x):
+        " Bounding boxes of the regions of interest in a volume `x` with shape (channels, *spatial_dims) "
+        size, coarse_sz = x.shape[-3:], self.coarse_size(x.shape[-3:])
+        coarse = F.interpolate(x[None].float(), size=coarse_sz, mode='trilinear', align_corners=False)
+        labels = self.predict(self.coarse_model, coarse)[0].argmax(0)
+        boxes = []
+        for c in self.classes:
+            box = bounding_box(labels == c)
+            if box is None: continue
+            boxes.append(tuple(slice(max(0, b.start * s // cs - self.margin), min(s, -(-b.stop * s // cs) + self.margin))
+                               for b, s, cs in zip(box, size, coarse_sz)))
+        boxes = [self.align(box, size) for box in merge_boxes(boxes)]
+        merged = merge_boxes(boxes)
+        while len(merged) < len(boxes): # grown boxes can overlap again
+            boxes = [self.align(box, size) for box in merged]
+            merged = merge_boxes(boxes)
+        return boxes
+
+    def align(self, box, size):
+        " Grow `box` to multiples of `downsampling_factor`, as far as the volume of `size` allows "
+        aligned = []
+        for b, s, f in zip(box, size, self.downsampling_factor):
+            length = min(s, -(-(b.stop - b.start) // f) * f)
+            start = min(b.start, s - length)
+            aligned.append(slice(start, start + length))
+        return tuple(aligned)
+
+    @torch.no_grad()
+    def __call__(self, x):
+        " Predict `x` with shape (batch_size, channels, *spatial_dims). Outside the regions of interest, the prediction decodes to `background` "
+        out = torch.empty(x.shape[0], self.n_classes, *x.shape[-3:])
+        out[:] = _one_hot(self.n_classes, self.background, self.probabilities).view(1, -1, 1, 1, 1)
+        for volume, o in zip(x, out):
+            for box in self.regions(volume): o[(slice(None), ) + box] = self.predict(self.model, volume[(None, slice(None)) + box])[0]
+        return out
+
+    @torch.no_grad()
+    def labels(self, x):
+        " Predict the labels of `x` with shape (batch_size, channels, *spatial_dims) as uint8 "
+        out = torch.full((x.shape[0], *x.shape[-3:]), self.background, dtype=torch.uint8)
+        for volume, o in zip(x, out):
+            for box in self.regions(volume): o[box] = self.predict(self.model, volume[(None, slice(None)) + box])[0].argmax(0)
+        return out
\ No newline at end of file
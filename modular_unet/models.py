@@ -5,10 +5,12 @@ __all__ = ['UResNet', 'UResNet18', 'UResNet18WithAttention', 'UResNet18DeepSuper
            'UResNet34WithAttention', 'UResNet34DeepSupervision', 'UResNet34WithAttentionAndDeepSupervision',
            'UResNet34WithSEAndAttentionAndDeepSupervision', 'UResNet50', 'UResNet50WithAttention',
            'UResNet50DeepSupervision', 'UResNet50WithAttentionAndDeepSupervision',
-           'UResNet50WithSEAndAttentionAndDeepSupervision']
+           'UResNet50WithSEAndAttentionAndDeepSupervision', 'scale_channels', 'compound_scaling', 'EfficientUNet',
+           'EfficientUNetB0', 'EfficientUNetB1', 'EfficientUNetB2', 'EfficientUNetB3']
 
 # Cell
 # default_exp models
+import math
 import torch
 from torch import nn
 from fastcore.dispatch import patch
@@ -17,7 +19,7 @@ from fastcore.dispatch import patch
 import sys
 sys.path.append('..')
 from .modular_unet import ModularUNet
-from .blocks import ResBlock, UnetBlock, ConvLayer, DoubleConv, SqueezeExpand, DeepSupervision
+from .blocks import ResBlock, UnetBlock, ConvLayer, DoubleConv, SqueezeExpand, DeepSupervision, MBConvBlock
 from .utils import test_forward
 
 # Cell
@@ -163,4 +165,62 @@ class UResNet50WithSEAndAttentionAndDeepSupervision(UResNet50):
     def decoder_layer(self, **kwargs):
         return UnetBlock(spatial_attention=True, **kwargs)
     def extra_after_decoder_layer(self, **kwargs):
-        return DeepSupervision(**kwargs)
\ No newline at end of file
+        return DeepSupervision(**kwargs)
+
+# Cell
+def scale_channels(channels, width_mult, divisor=8):
+    " Scale `channels` by `width_mult` and round to a multiple of `divisor`, but not more than 10% down "
+    scaled = channels * width_mult
+    rounded = max(divisor, int(scaled + divisor / 2) // divisor * divisor)
+    return rounded + divisor if rounded < 0.9 * scaled else rounded
+
+def compound_scaling(base, # a `ModularUNet` subclass with the configuration to scale
+                     width_mult, # multiplier for the channels of each stage
+                     depth_mult # multiplier for the number of layers of each stage
+                    ):
+    " Channels and number of layers of `base`, scaled by `width_mult` and `depth_mult` "
+    return (tuple(scale_channels(c, width_mult) for c in base.channels),
+            tuple(math.ceil(n * depth_mult) for n in base.n_layers))
+
+# Cell
+class EfficientUNet(ModularUNet):
+    " UNet with an EfficientNet-like encoder of `MBConvBlock`s "
+    expand_ratio = 6 # channel expansion of the inverted bottlenecks
+    se_ratio = 0.25 # squeeze and excitation ratio
+
+    def create_encoder_layer(self, stage, layer, **kwargs):
+        # the first layer of the first stage is the stem, the first stochastic depth rate is always 0
+        if stage == layer == 0: return ConvLayer(act=nn.SiLU, **kwargs)
+        return super().create_encoder_layer(stage, layer, **kwargs)
+    def encoder_layer(self, in_c, out_c, ks, stride, padding, stochastic_depth=0., stochastic_depth_mode='row', **kwargs):
+        return MBConvBlock(in_c, out_c, ks, stride, self.se_ratio, True, self.expand_ratio,
+                           drop_connect_rate=stochastic_depth, stochastic_depth_mode=stochastic_depth_mode,
+                           padding=padding, **kwargs)
+    def middle_layer(self, in_c, **kwargs):
+        return MBConvBlock(in_c, in_c, 3, 1, self.se_ratio, True, self.expand_ratio, drop_connect_rate=0., **kwargs)
+    def skip_layer(self, **kwargs): return nn.Identity()
+    def decoder_layer(self, **kwargs): return UnetBlock(**kwargs)
+    def extra_after_decoder_layer(self, **kwargs): return nn.Identity()
+
+# Cell
+class EfficientUNetB0(EfficientUNet):
+    " UNet with EfficientNet-B0-like encoder "
+    channels = 16, 24, 40, 112, 192
+    kernel_size = 3, 3, 5, 3, 5
+    stride = 2, 2, 2, 2, 2
+    padding = 'auto', 'auto', 'auto', 'auto', 'auto'
+    n_layers = 1, 2, 2, 3, 4
+    n_blocks = 5
+
+# Cell
+class EfficientUNetB1(EfficientUNetB0):
+    " UNet with EfficientNet-B1-like encoder "
+    channels, n_layers = compound_scaling(EfficientUNetB0, width_mult=1.0, depth_mult=1.1)
+
+class EfficientUNetB2(EfficientUNetB0):
+    " UNet with EfficientNet-B2-like encoder "
+    channels, n_layers = compound_scaling(EfficientUNetB0, width_mult=1.1, depth_mult=1.2)
+
+class EfficientUNetB3(EfficientUNetB0):
+    " UNet with EfficientNet-B3-like encoder "
+    channels, n_layers = compound_scaling(EfficientUNetB0, width_mult=1.2, depth_mult=1.4)
\ No newline at end of file
@@ -1,12 +1,19 @@
 # AUTOGENERATED! DO NOT EDIT! File to edit: nbs/modular_unet.ipynb (unless otherwise specified).
 
-__all__ = ['ModularUNet']
+__all__ = ['add_upsampled', 'pad_to_multiple', 'crop_padding', 'keep_running_stats', 'update_stats_once', 'ModularUNet',
+           'checkpoint_cost', 'load_legacy_state_dict']
 
 # Cell
 # default_exp modular_unet
+import time
+import inspect
 import torch
 from torch import nn
 from torch.nn import functional as F
+import torch.utils.checkpoint
+from functools import partial
+from contextlib import contextmanager
+from typing import List, Tuple
 from collections import OrderedDict
 
 from fastcore.dispatch import patch
@@ -18,29 +25,88 @@ sys.path.append('..')
 from .blocks import ConvLayer
 from .utils import hasattrs
 
+# Cell
+def add_upsampled(x, o):
+    " Add `o`, upsampled to the size of `x` with nearest interpolation, to `x` inplace "
+    factor = [a // b for a, b in zip(x.shape[2:], o.shape[2:])]
+    if all(a == b * f for a, b, f in zip(x.shape[2:], o.shape[2:], factor)):
+        # integer factors: broadcast `o` into a view of `x` without allocating the upsampled tensor
+        b, c, d, h, w = o.shape
+        x.view(b, c, d, factor[0], h, factor[1], w, factor[2]).add_(o[:, :, :, None, :, None, :, None])
+    else: x.add_(F.interpolate(o, x.shape[2:], mode='nearest'))
+    return x
+
+# Cell
+def pad_to_multiple(x, factor:List[int]) -> Tuple[torch.Tensor, List[int]]:
+    " Pad the spatial dimensions of `x` to the next multiple of `factor`. Returns `x` and the padding of each axis "
+    pad: List[int] = []
+    for size, f in zip(x.shape[-3:], factor):
+        total = (f - size % f) % f
+        pad += [total // 2, total - total // 2]
+    if max(pad) == 0: return x, pad # avoid the copy of `F.pad`
+    return F.pad(x, pad[4:] + pad[2:4] + pad[:2]), pad # `F.pad` starts with the last axis
+
+def crop_padding(x, pad:List[int]):
+    " Remove the padding of `pad_to_multiple` from the spatial dimensions of `x` "
+    d, h, w = x.shape[-3:]
+    return x[..., pad[0]:d - pad[1], pad[2]:h - pad[3], pad[4]:w - pad[5]]
+
+# Cell
+@contextmanager
+def keep_running_stats(module):
+    " Restore the running statistics of all `BatchNorm` layers in `module` when the context exits "
+    norms = [m for m in module.modules() if isinstance(m, nn.modules.batchnorm._BatchNorm) and m.track_running_stats]
+    stats = [b for m in norms for b in (m.running_mean, m.running_var, m.num_batches_tracked)]
+    saved = [b.clone() for b in stats]
+    try: yield
+    finally:
+        with torch.no_grad():
+            for b, s in zip(stats, saved): b.copy_(s)
+
+def update_stats_once(block):
+    " Wrap `block` for `torch.utils.checkpoint`, so recomputing it in the backward pass keeps the `BatchNorm` statistics "
+    calls = 0
+    def run(*args):
+        nonlocal calls
+        calls += 1
+        if calls == 1: return block(*args) # the forward pass updates the statistics
+        with keep_running_stats(block): return block(*args)
+    return run
+
 # Cell
 class ModularUNet(nn.Module):
     " Modular 3D UNet "
+    profiler = None # records each block call if set, e.g. by `StageProfiler`
 
     def __init__(self,
                  in_c:int, # number of input channels
                  n_classes:int, # number of output channels / number of classes
                  norm=nn.BatchNorm3d, # type of batch nornalization
                  act=nn.ReLU, # activation function
+                 checkpoint=None, # blocks to recompute during backward: 'all', 'encoder', 'decoder' or a list of indices or block names
+                 fusion='concat', # how deep supervision outputs are combined: 'concat' or 'project' (lower memory)
+                 precision=None, # run inference with reduced precision: 'bfloat16' or 'float16'
+                 stochastic_depth=0., # maximum probability to skip an encoder layer during training, increases linearly with depth
+                 stochastic_depth_mode='row', # skip encoder layers per sample ('row') or for the whole batch ('batch')
+                 shape_policy='resize', # inputs not divisible by `downsampling_factor`: 'resize' feature maps or 'pad' the input
                  **kwargs # further arguments for ConvLayer
                 ):
         super(ModularUNet, self).__init__()
         store_attr(store_args=True) # saves all attributes to self
 
         hasattrs(self, ('channels', 'kernel_size', 'stride', 'padding', 'n_layers', 'n_blocks'), do_raise=True)
+        if stochastic_depth_mode not in ('row', 'batch'):
+            raise ValueError(f"Expected `stochastic_depth_mode` to be 'row' or 'batch', but got {stochastic_depth_mode}")
 
         # encoder layers (downsampling)
         original_in_c = in_c
+        drop_rates = self.stochastic_depth_rates()
         for i in range(self.n_blocks):
             setattr(self,
                     f'encoder_block_{i}',
                     self.create_encoder_block(in_c, self.channels[i], self.kernel_size[i],
-                                              self.stride[i], self.padding[i], self.n_layers[i], **kwargs)
+                                              self.stride[i], self.padding[i], self.n_layers[i],
+                                              drop_rates=drop_rates[i], stage=i, **self._stage_kwargs(i, kwargs))
                    )
             in_c = self.channels[i]
 
@@ -55,32 +121,71 @@ class ModularUNet(nn.Module):
         self.middle_block = self.create_middle_block(self.channels[-1], **kwargs)
 
         # Decoder (upsampling)
+        in_c = self.channels[-1] # output of the middle block
         for i in reversed(range(self.n_blocks)):
             s_c = self.channels[i-1] if i > 0 else original_in_c
-            setattr(self, f'decoder_block_{i}', self.create_decoder_block(in_c=self.channels[i], s_c=s_c, **kwargs))
+            setattr(self, f'decoder_block_{i}',
+                    self.create_decoder_block(in_c=in_c, s_c=s_c, **self._stage_kwargs(i, kwargs),
+                                              **self._upsampling_kwargs(i)))
 
-            in_c = (s_c + self.channels[i]//2) // 2
+            # output of the decoder block, equal to `s_c` if the channels double in each block
+            in_c = (s_c + in_c//2) // 2
             setattr(self, f'extra_after_decoder_block_{i}',
                     self.create_extra_after_decoder_block(in_c=in_c, out_c=n_classes, **kwargs))
 
         # Final layer (n_channels -> n_classes)
-        if not isinstance(self.extra_after_decoder_block_0, nn.Identity):
+        if self.deep_supervision:
             in_c = n_classes * self.n_blocks
         self.final_block = self.create_final_block(in_c, n_classes)
+        self.checkpointed_blocks # raises early if `checkpoint` is not a valid policy
+        if fusion not in ('concat', 'project'):
+            raise ValueError(f"Expected `fusion` to be 'concat' or 'project', but got {fusion}")
+        if shape_policy not in ('resize', 'pad'):
+            raise ValueError(f"Expected `shape_policy` to be 'resize' or 'pad', but got {shape_policy}")
+        if precision not in (None, 'bfloat16', 'float16'):
+            raise ValueError(f"Expected `precision` to be None, 'bfloat16' or 'float16', but got {precision}")
+        if fusion == 'project' and self.deep_supervision and self._final_input_projections() is None:
+            raise ValueError("`fusion='project'` requires a final block with `input_projections`, e.g. a 1x1x1 `ConvLayer`")
 
     # Each block is created with a `create`_block` function, which passes arguments to the `layer` function
     # The `layer` function can either be patched to ModularUnet or added in a subclass.
-    def create_encoder_block(self, in_c, out_c, ks, stride, padding, n_layers, **kwargs):
-        " Create `n_layers` instances of `encoder_layer` "
+    def create_encoder_block(self, in_c, out_c, ks, stride, padding, n_layers, drop_rates=None, stage=None, **kwargs):
+        " Create `n_layers` instances of `encoder_layer`, with stochastic depth `drop_rates` for each layer "
+        # `stage` is the index of the block, passed to `create_encoder_layer` with the index of each layer
         assert hasattr(self, 'encoder_layer'), self._not_implemented_error('encoder_layer')
-        layers = OrderedDict([('layer_0', self.encoder_layer(in_c=in_c, out_c=out_c, ks=ks, stride=stride,
-                                                            padding=padding, **kwargs))])
+        drop = [self._stochastic_depth_kwargs(p) for p in (drop_rates or [0.] * n_layers)]
+        layers = OrderedDict([('layer_0', self.create_encoder_layer(stage, 0, in_c=in_c, out_c=out_c, ks=ks,
+                                                                    stride=stride, padding=padding, **drop[0], **kwargs))])
         if n_layers == 1: return nn.Sequential(layers)
-        for i in range(n_layers - 1):
-            layers[f'layer_{i+1}'] = self.encoder_layer(in_c=out_c, out_c=out_c, ks=ks, stride=stride,
-                                                        padding=padding, **kwargs)
+        for i in range(n_layers - 1): # only the first layer of a block downsamples
+            layers[f'layer_{i+1}'] = self.create_encoder_layer(stage, i+1, in_c=out_c, out_c=out_c, ks=ks,
+                                                                stride=1, padding=padding, **drop[i+1], **kwargs)
         return nn.Sequential(layers)
 
+    def create_encoder_layer(self, stage, layer, **kwargs):
+        " Build layer `layer` of encoder block `stage`. Subclasses can override it to build some layers differently "
+        return self.encoder_layer(**kwargs)
+
+    def stochastic_depth_rates(self):
+        " Probability to skip each encoder layer, increasing linearly from 0 to `stochastic_depth`, grouped by block "
+        n_layers = list(self.n_layers[:self.n_blocks])
+        rates = [self.stochastic_depth * i / max(1, sum(n_layers) - 1) for i in range(sum(n_layers))]
+        return [rates[sum(n_layers[:i]):sum(n_layers[:i+1])] for i in range(self.n_blocks)]
+
+    def _stage_kwargs(self, i, kwargs):
+        # `conv_mode` can be set per stage in the class configuration, next to `kernel_size` and `stride`
+        if hasattr(self, 'conv_mode'): return {**kwargs, 'conv_mode': self.conv_mode[i]}
+        return kwargs
+
+    def _upsampling_kwargs(self, i):
+        # a decoder block upsamples by the stride of its encoder block, passed if it differs from `UnetBlock`'s default
+        return {} if self.stride[i] == 2 else {'stride': self.stride[i]}
+
+    def _stochastic_depth_kwargs(self, p):
+        # only passed to layers which are skipped, so `encoder_layer`s without stochastic depth still work
+        if p == 0: return {}
+        return {'stochastic_depth': p, 'stochastic_depth_mode': self.stochastic_depth_mode}
+
     def create_skip_block(self, in_c, **kwargs):
         " Build skip blocks "
         assert hasattr(self, 'skip_layer'), self._not_implemented_error('skip_layer')
@@ -107,72 +212,170 @@ class ModularUNet(nn.Module):
             return self.final_layer(in_c=in_c, out_c=out_c)
         return ConvLayer(in_c, out_c, ks=1, **kwargs, act=None, norm=None)
 
+    @property
+    def downsampling_factor(self):
+        " Total downsampling of the encoder along each spatial axis "
+        factor = [1, 1, 1]
+        for stride in self.stride[:self.n_blocks]:
+            if isinstance(stride, int): stride = (stride, )*3
+            factor = [f * s for f, s in zip(factor, stride)]
+        return tuple(factor)
+
+    @property
+    def deep_supervision(self):
+        " True if the outputs of all decoder blocks are combined in the final block "
+        return not isinstance(self.extra_after_decoder_block_0, nn.Identity)
+
+    @property
+    def checkpointed_blocks(self):
+        " Names of the blocks, which recompute their activations during the backward pass "
+        if not self.checkpoint: return set()
+        encoder = {f'encoder_block_{i}' for i in range(self.n_blocks)}
+        decoder = {f'decoder_block_{i}' for i in range(self.n_blocks)}
+        if self.checkpoint == 'all': return encoder | {'middle_block'} | decoder
+        if self.checkpoint == 'encoder': return encoder
+        if self.checkpoint == 'decoder': return decoder
+        if isinstance(self.checkpoint, str):
+            raise ValueError(f"Expected `checkpoint` to be 'all', 'encoder', 'decoder' or a list, "
+                             f"but got {self.checkpoint}")
+        blocks = set()
+        for block in self.checkpoint:
+            if isinstance(block, int): blocks |= {f'encoder_block_{block}', f'decoder_block_{block}'}
+            else: blocks.add(block)
+        unknown = blocks - encoder - decoder - {'middle_block'}
+        if unknown: raise ValueError(f'Can not checkpoint unknown blocks {sorted(unknown)}')
+        return blocks
+
+    def run_block(self, name, *args):
+        " Call block `name`. Checkpoint it if selected by `checkpoint` and record it if a `profiler` is attached "
+        block = getattr(self, name)
+        if self.checkpoint and self.training and torch.is_grad_enabled() and name in self.checkpointed_blocks:
+            block = partial(torch.utils.checkpoint.checkpoint, update_stats_once(block), use_reentrant=False)
+        if self.profiler is not None: return self.profiler.record(name, block, *args)
+        return block(*args)
+
     # implement forward functions for each part of the Modular UNet
+    # skip connections are passed between the functions as a list `s` and not stored in the model,
+    # so they can be freed as soon as possible and a model can be shared between threads
     def forward_encoder(self, x):
-        " x -> [x1, x2, .. , xn]. Store x1, .. , xn, return xn"
+        " x -> [x1, x2, .. , xn]. Return xn and skip connections [x, x1, .. , x(n-1)]"
         # downsampling
-        self.s = [x] # collect outouts for skip connections
+        s = [] # collect outputs for skip connections
         for i in range(self.n_blocks):
-            x = getattr(self, f'encoder_block_{i}')(x)
-            self.s.append(x) # store intermediate output as skip connection
-        return x
+            s.append(x) # store input of each block as skip connection
+            x = self.run_block(f'encoder_block_{i}', x)
+        return x, s
 
-    def forward_skip(self):
-        "x1 -> x1', x2 -> x2', .. , xn -> xn'"
+    def forward_skip(self, s):
+        "x1 -> x1', x2 -> x2', .. , x(n-1) -> x(n-1)'"
         for i in range(self.n_blocks - 1):
-            # self.s[0] is the input, not the output from the first encoder block
-            # so self.s[1] will yield the output from encoder_block_0 for skip_block_0
-            self.s[i+1] = getattr(self, f'skip_block_{i}')(self.s[i+1])
+            # s[0] is the input, not the output from the first encoder block
+            # so s[1] will yield the output from encoder_block_0 for skip_block_0
+            s[i+1] = self.run_block(f'skip_block_{i}', s[i+1])
+        return s
 
     def forward_middle(self, x):
         " x -> x "
-        return self.middle_block(x)
+        return self.run_block('middle_block', x)
 
-    def forward_decoder(self, x):
+    def forward_decoder(self, x, s):
         "x + x1 -> x_up1, x_up1 + x2 -> x_up2, .. , x_up(n-1) + x_n -> x_upn"
         # upsampling
         for i in reversed(range(self.n_blocks)):
-            x = getattr(self, f'decoder_block_{i}')(x, self.s[i])
-            # len(s) == (self.n_layers + 1), so s[i] will yield the right skip connection
-            self.s[i] = (x) # store output from U-Net Block for use in e.g. Deep Supervision
-
-        # self.s = [x_up1, x_up2, .., x_upn, xn], where xn is the output from `self.middle_block`
-        # xn is not needed anymore and can be removed
-        self.s = self.s[:-1]
-        return x
+            x = self.run_block(f'decoder_block_{i}', x, s[i])
+            # the skip connection is not needed anymore. Replace it with the output from the U-Net Block
+            # if it is needed later for e.g. Deep Supervision, else free it
+            s[i] = x if self.deep_supervision else None
+        return x, s
 
-    def forward_extra_after_decoder(self):
+    def forward_extra_after_decoder(self, s):
         "x_up1 -> x_up1', x_up2 -> x_up2', .. , x_upn -> x_upn'"
         for i in reversed(range(self.n_blocks)):
-            # self.s[0] is the out, not the output from the last decoder block (decoder_block_0)
-            # so self.s[n_blocks]  is the output of the first decoder block (decoder_block_(n_blocks))
-            self.s[i] = getattr(self, f'extra_after_decoder_block_{i}')(self.s[i])
+            # s[0] is the output from the last decoder block (decoder_block_0)
+            # so s[n_blocks-1] is the output of the first decoder block (decoder_block_(n_blocks-1))
+            s[i] = self.run_block(f'extra_after_decoder_block_{i}', s[i])
+        return s
 
     def forward_final(self, x):
         "x -> classes"
         # final layer
-        return self.final_block(x)
+        return self.run_block('final_block', x)
+
+    def fuse_deep_supervision(self, s, sz):
+        "[x_up1', x_up2', .. , x_upn'] -> x. Resize the outputs of all extra layers to `sz` and concatenate them"
+        return torch.cat([F.interpolate(o, sz, mode='nearest') for o in s], 1)
+
+    def _final_input_projections(self):
+        " 1x1x1 convolutions which read the input of `final_block`, see `ConvLayer.input_projections` "
+        input_projections = getattr(self.final_block, 'input_projections', None)
+        return input_projections() if input_projections is not None else None
+
+    def project_deep_supervision(self, s, sz):
+        "[x_up1', x_up2', .. , x_upn'] -> classes. Same as `final_block(fuse_deep_supervision(s, sz))` with less memory"
+        # a 1x1x1 conv of the concatenated outputs is the sum of 1x1x1 convs of each output and commutes with
+        # nearest upsampling. Projecting each output at its own scale before upsampling only allocates full
+        # resolution maps with the output channels of the convs, instead of `n_classes * n_blocks` channels
+        convs = self._final_input_projections()
+        weights = [conv.weight.split([o.shape[1] for o in s], 1) for conv in convs]
+        xs = [s[0].new_zeros(s[0].shape[0], conv.out_channels, *sz) for conv in convs]
+        for i in range(len(s)):
+            for x, weight in zip(xs, weights): add_upsampled(x, F.conv3d(s[i], weight[i]))
+            s[i] = None # free each output as soon as it is projected
+        for x, conv in zip(xs, convs):
+            if conv.bias is not None: x.add_(conv.bias.view(1, -1, 1, 1, 1))
+        return self.final_block.forward_from_projections(*xs)
 
     def forward(self, x):
+        if self.precision is not None and not self.training:
+            # convolutions run with reduced precision, sensitive layers like `SigmoidFloat32` stay in float32.
+            # The input is cast as well, as it is also used as skip connection. Without the cache, weights are cast
+            # when used and not kept in memory until the end of the forward pass
+            dtype = getattr(torch, self.precision)
+            with torch.autocast(x.device.type, dtype=dtype, cache_enabled=False):
+                return self.forward_unet(x.to(dtype)).float()
+        return self.forward_unet(x)
+
+    def forward_unet(self, x):
+        " Forward pass through all blocks "
+        # with `shape_policy='pad'` the input is padded once, so no block needs to resize its feature maps
+        if self.shape_policy == 'pad': x, pad = pad_to_multiple(x, self.downsampling_factor)
         sz = x.shape[-3:] # store size for resizing
 
-        x = self.forward_encoder(x)
-        self.forward_skip()
+        x, s = self.call_hook('forward_encoder', x)
+        s = self.call_hook('forward_skip', s=s)
         x = self.forward_middle(x)
-#         x = self.forward_extra_after_skip(x) # maybe added later. A global layer with access to all tensors sored in self.s
-        x = self.forward_decoder(x)
-        self.forward_extra_after_decoder()
-        # if `forward_extra_after_decoder` changed self.s, then the combined tensors of
-        # self.s are passed to the final block. For this they need to be resized and concatenated
-        if not isinstance(self.extra_after_decoder_block_0, nn.Identity):
-            self.s = [F.interpolate(s, sz, mode='nearest') for s in self.s]
-            x = torch.cat(self.s, 1)
-        x = self.forward_final(x)
+        x, s = self.call_hook('forward_decoder', x, s=s)
+        # with deep supervision, the outputs of all decoder blocks are passed through the extra layers and
+        # the combined tensors are passed to the final block. For this they need to be resized and concatenated
+        # or, with `fusion='project'`, passed through the final block at their own scale and then resized and summed
+        projected = self.deep_supervision and self.fusion == 'project'
+        if self.deep_supervision:
+            s = self.call_hook('forward_extra_after_decoder', s=s)
+            x = self.run_block('project_deep_supervision' if projected else 'fuse_deep_supervision', s, sz)
+        del s
+        self.__dict__.pop('s', None) # set by legacy hooks, see `call_hook`
+        if not projected: x = self.forward_final(x)
 
         # final resize
         if x.shape[-3:] != sz:
             x = F.interpolate(x, sz, mode='nearest')
-        return x
+        return crop_padding(x, pad) if self.shape_policy == 'pad' else x
+
+    def call_hook(self, name, x=None, s=None):
+        " Call the `forward_*` function `name`, also if a subclass overrides it with the legacy signature "
+        # legacy hooks do not take the skip connections `s`, but read and write them as `self.s`,
+        # which holds [x, x1, .. , xn] after the encoder and the decoder outputs after the decoder
+        hook = getattr(self, name)
+        if name == 'forward_encoder':
+            out = hook(x)
+            return out if isinstance(out, tuple) else (out, self.s[:self.n_blocks])
+        if 's' in inspect.signature(hook).parameters: return hook(s) if x is None else hook(x, s)
+        if name == 'forward_decoder':
+            self.s = s + [x] # the legacy decoder drops the last entry, the output of the encoder
+            return hook(x), self.s
+        self.s = s
+        hook()
+        return self.s
 
     def _not_implemented_error(self, layer_name):
         msg1, msg2 = 'For example:\n@patch\ndef', '(self:ModularUNet, **kwargs): return'
@@ -186,4 +389,42 @@ class ModularUNet(nn.Module):
         raise NotImplementedError(f'self.{layer_name} is not implemented for `ModularUNet`. '
                                   f'It can be added using the `@patch` decorator or by subclassing `ModularUNet`'
                                   f'{msg1} {layer_name} {msg2} {patch}'
-                                 )
\ No newline at end of file
+                                 )
+
+# Cell
+def checkpoint_cost(model, x, policies=(None, 'encoder', 'decoder', 'all'), n_iter=3):
+    " Memory of activations saved for backward (MiB) and time of one training step (s) for each checkpointing policy "
+    params = {p.untyped_storage().data_ptr() for p in model.parameters()}
+    def pack(t):
+        storage = t.untyped_storage()
+        if storage.data_ptr() not in params: saved[storage.data_ptr()] = storage.nbytes()
+        return t
+
+    checkpoint, training, results = model.checkpoint, model.training, {}
+    model.train()
+    try:
+        for policy in policies:
+            model.checkpoint = policy
+            model.checkpointed_blocks # validate policy
+            times = []
+            for _ in range(n_iter):
+                saved = {}
+                start = time.perf_counter()
+                with torch.autograd.graph.saved_tensors_hooks(pack, lambda t: t):
+                    loss = model(x).float().mean()
+                loss.backward()
+                times.append(time.perf_counter() - start)
+                model.zero_grad()
+            results[str(policy)] = {'activations_mib': sum(saved.values()) / 2**20, 'step_s': min(times)}
+    finally:
+        model.checkpoint = checkpoint
+        model.train(training)
+    return results
+
+# Cell
+def load_legacy_state_dict(model, state_dict):
+    " Load a `state_dict` saved when every layer of an encoder block downsampled, dropping the obsolete weights "
+    # the later layers of a block have no `downsample` branch anymore, as they keep the size and channels
+    own = model.state_dict()
+    obsolete = {k for k in state_dict if k.startswith('encoder_block_') and '.downsample.' in k and k not in own}
+    return model.load_state_dict({k: v for k, v in state_dict.items() if k not in obsolete})
\ No newline at end of file
@@ -0,0 +1,126 @@
+# AUTOGENERATED! DO NOT EDIT! File to edit: nbs/optimize.ipynb (unless otherwise specified).
+
+__all__ = ['fuse_conv_bn', 'ChannelAffine', 'fuse_for_inference', 'StaticUNet', 'script_for_inference']
+
+# Cell
+# default_exp optimize
+import torch
+import torch.fx
+from torch import nn
+from torch.nn import functional as F
+from copy import deepcopy
+from typing import List
+
+# Cell
+import sys
+sys.path.append('..')
+from .modular_unet import ModularUNet, pad_to_multiple, crop_padding
+from .blocks import resize_like
+
+# Cell
+def _bn_scale_shift(bn):
+    " Per-channel scale and shift of `bn` in eval mode "
+    scale = torch.rsqrt(bn.running_var + bn.eps)
+    if bn.affine: scale = scale * bn.weight
+    shift = -bn.running_mean * scale
+    if bn.affine: shift = shift + bn.bias
+    return scale.detach(), shift.detach()
+
+# Cell
+@torch.no_grad()
+def fuse_conv_bn(conv, bn):
+    " Fold `bn` into the weights and bias of `conv` (a `Conv3d` or `ConvTranspose3d`) "
+    scale, shift = _bn_scale_shift(bn)
+    weight = conv.weight
+    if isinstance(conv, nn.ConvTranspose3d):
+        # weight is (in_c, out_c // groups, *ks), scale the output channels of each group
+        w = weight.view(conv.groups, weight.shape[0] // conv.groups, weight.shape[1], *weight.shape[2:])
+        w.mul_(scale.view(conv.groups, 1, -1, *[1]*(weight.dim()-2)))
+    else: weight.mul_(scale.view(-1, *[1]*(weight.dim()-1)))
+    bias = conv.bias if conv.bias is not None else torch.zeros_like(scale)
+    conv.bias = nn.Parameter(bias * scale + shift)
+    return conv
+
+# Cell
+class ChannelAffine(nn.Module):
+    " Per-channel affine transformation `x * scale + shift`, e.g. a `BatchNorm3d` in eval mode "
+    def __init__(self, scale, shift):
+        super(ChannelAffine, self).__init__()
+        self.register_buffer('scale', scale.view(1, -1, 1, 1, 1))
+        self.register_buffer('shift', shift.view(1, -1, 1, 1, 1))
+
+    @classmethod
+    def from_bn(cls, bn): return cls(*_bn_scale_shift(bn))
+
+    def forward(self, x):
+        return torch.addcmul(self.shift, x, self.scale)
+
+# Cell
+def _output_conv(module):
+    " The convolution which produces the output of `module`, e.g. `FactorizedConv3d.through_plane` "
+    while isinstance(module, nn.Sequential) and len(module): module = module[-1]
+    return module if isinstance(module, (nn.Conv3d, nn.ConvTranspose3d)) else None
+
+def fuse_for_inference(model:nn.Module, inplace=False):
+    " Fold all `BatchNorm3d` layers of `model` into the preceding convolutions for faster inference "
+    if not inplace: model = deepcopy(model)
+    model.eval()
+    for module in list(model.modules()):
+        if not isinstance(module, nn.Sequential): continue
+        names = list(module._modules.keys())
+        for prev, name in zip(names[:-1], names[1:]):
+            conv, bn = _output_conv(module._modules.get(prev)), module._modules.get(name)
+            if conv is not None and isinstance(bn, nn.BatchNorm3d) and bn.track_running_stats:
+                fuse_conv_bn(conv, bn)
+                delattr(module, name)
+    # remaining BatchNorms are replaced by their affine transformation
+    for module in list(model.modules()):
+        for name, child in module.named_children():
+            if isinstance(child, nn.BatchNorm3d) and child.track_running_stats:
+                setattr(module, name, ChannelAffine.from_bn(child))
+    return model
+
+# Cell
+torch.fx.wrap('resize_like') # `resize_like` contains a shape dependent branch
+torch.fx.wrap('pad_to_multiple') # padding and cropping depend on the input shape
+torch.fx.wrap('crop_padding')
+
+class StaticUNet(nn.Module):
+    " The blocks of a `ModularUNet` with a static forward pass, which can be scripted or traced with `torch.fx` "
+    def __init__(self, model:ModularUNet):
+        super(StaticUNet, self).__init__()
+        n = model.n_blocks
+        self.encoder = nn.ModuleList([getattr(model, f'encoder_block_{i}') for i in range(n)])
+        # no skip block for the input, which is the skip connection of `decoder_block_0`
+        self.skip = nn.ModuleList([nn.Identity()] + [getattr(model, f'skip_block_{i}') for i in range(n - 1)])
+        self.middle = model.middle_block
+        # decoder and extra blocks in order of execution, from the lowest to the highest resolution
+        self.decoder = nn.ModuleList([getattr(model, f'decoder_block_{i}') for i in reversed(range(n))])
+        self.extra = nn.ModuleList([getattr(model, f'extra_after_decoder_block_{i}') for i in reversed(range(n))])
+        self.final = model.final_block
+        self.deep_supervision = model.deep_supervision
+        self.pad, self.factor = model.shape_policy == 'pad', list(model.downsampling_factor)
+        self.train(model.training)
+
+    def forward(self, x):
+        pad: List[int] = []
+        if self.pad: x, pad = pad_to_multiple(x, self.factor)
+        inp = x
+        s: List[torch.Tensor] = []
+        for encoder, skip in zip(self.encoder, self.skip):
+            s.append(skip(x))
+            x = encoder(x)
+        x = self.middle(x)
+        outputs: List[torch.Tensor] = []
+        for decoder, extra in zip(self.decoder, self.extra):
+            x = decoder(x, s.pop()) # the last skip connection belongs to the first decoder block
+            if self.deep_supervision: outputs.append(extra(x))
+        if self.deep_supervision:
+            x = torch.cat([F.interpolate(o, inp.shape[2:], mode='nearest') for o in outputs[::-1]], 1)
+        x = resize_like(self.final(x), inp)
+        return crop_padding(x, pad) if self.pad else x
+
+# Cell
+def script_for_inference(model:ModularUNet):
+    " Script, freeze and optimize `model` for inference with TorchScript "
+    with torch.no_grad(): return torch.jit.optimize_for_inference(torch.jit.script(StaticUNet(model).eval()))
\ No newline at end of file
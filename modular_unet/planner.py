@@ -0,0 +1,86 @@
+# AUTOGENERATED! DO NOT EDIT! File to edit: nbs/planner.ipynb (unless otherwise specified).
+
+__all__ = ['plan_topology', 'plan']
+
+# Cell
+# default_exp planner
+import math
+
+# Cell
+import sys
+sys.path.append('..')
+from .estimate import estimate
+from .models import UResNet
+
+# Cell
+def plan_topology(patch_size, # spatial size of the training patches
+                  spacing, # voxel spacing of the dataset, e.g. in mm
+                  max_blocks=5, # maximum number of encoder blocks
+                  min_feature_size=4, # minimum size of the feature maps along each axis after the last block
+                 ):
+    " Per-axis `kernel_size` and `stride` of each stage for `patch_size` and `spacing` "
+    kernel_size, stride = [], []
+    size, spacing = list(patch_size), list(spacing)
+    for _ in range(max_blocks):
+        # axes with more than twice the finest spacing are neither convolved nor downsampled yet
+        similar = [sp <= 2 * min(spacing) for sp in spacing]
+        st = tuple(2 if sim and sz >= 2 * min_feature_size else 1 for sim, sz in zip(similar, size))
+        if st == (1, 1, 1): break
+        kernel_size.append(tuple(3 if sim else 1 for sim in similar))
+        stride.append(st)
+        size = [sz // s for sz, s in zip(size, st)]
+        spacing = [sp * s for sp, s in zip(spacing, st)]
+    return tuple(kernel_size), tuple(stride)
+
+# Cell
+def _downsampling_factor(stride): return [math.prod(s[i] for s in stride) for i in range(3)]
+
+def _round_to_factor(patch_size, factor): return [max(f, sz // f * f) for sz, f in zip(patch_size, factor)]
+
+def _config(patch_size, spacing, base, base_channels, max_channels, max_blocks, min_feature_size):
+    kernel_size, stride = plan_topology(patch_size, spacing, max_blocks, min_feature_size)
+    n_blocks = len(stride)
+    if n_blocks == 0: raise ValueError(f'Patch size {tuple(patch_size)} is too small to be downsampled')
+    return {'channels': tuple(min(max_channels, base_channels * 2**i) for i in range(n_blocks)),
+            'kernel_size': kernel_size, 'stride': stride,
+            'padding': ('auto', ) * n_blocks,
+            'n_layers': tuple(base.n_layers[:n_blocks]) if hasattr(base, 'n_layers') else (1, ) + (2, ) * (n_blocks - 1),
+            'n_blocks': n_blocks}
+
+def _step_mib(model, patch_size, in_c, n_classes, **kwargs):
+    " Activation memory of one sample and memory of parameters, gradients and optimizer state "
+    est = estimate(model, in_c, n_classes, inp_sz=tuple(patch_size), batch_size=1, **kwargs)
+    return est['training_peak_mib'], 4 * est['param_mib']
+
+# Cell
+def plan(spacing, # voxel spacing of the dataset, e.g. in mm
+         median_shape, # median shape of the volumes in the dataset
+         memory_mib, # memory budget of one training step
+         in_c=1, # number of input channels
+         n_classes=2, # number of output channels
+         base=UResNet, # `ModularUNet` subclass providing the layers
+         base_channels=32, # channels of the first block, doubled in each further block
+         max_channels=512, # maximum number of channels of a block
+         max_blocks=5, # maximum number of encoder blocks
+         min_feature_size=4, # minimum size of the feature maps along each axis after the last block
+         min_batch_size=2, # the patch size is reduced until this batch size fits
+         max_batch_size=16, # the batch size is not increased further
+         **kwargs # further arguments for `base`
+        ):
+    " Plan a subclass of `base` and the largest patch and batch size of a training step that fit `memory_mib` "
+    patch_size = list(median_shape)
+    while True:
+        config = _config(patch_size, spacing, base, base_channels, max_channels, max_blocks, min_feature_size)
+        patch_size = _round_to_factor(patch_size, _downsampling_factor(config['stride']))
+        model = type(f'Planned{base.__name__}', (base, ), config)
+        sample_mib, fixed_mib = _step_mib(model, patch_size, in_c, n_classes, **kwargs)
+        batch_size = min(max_batch_size, int((memory_mib - fixed_mib) // sample_mib))
+        if batch_size >= min_batch_size: break
+        # shrink the axis with the largest physical extent, which can still be downsampled afterwards
+        factor = _downsampling_factor(config['stride'])
+        candidates = [i for i in range(3) if patch_size[i] - factor[i] >= 2 * min_feature_size]
+        if not candidates: raise ValueError(f'A batch of {min_batch_size} does not fit into {memory_mib} MiB')
+        axis = max(candidates, key=lambda i: patch_size[i] * spacing[i])
+        patch_size[axis] -= factor[axis]
+    return {'model': model, 'config': config, 'patch_size': tuple(patch_size), 'batch_size': batch_size,
+            'memory_mib': fixed_mib + batch_size * sample_mib}
\ No newline at end of file
@@ -0,0 +1,111 @@
+# AUTOGENERATED! DO NOT EDIT! File to edit: nbs/profiling.ipynb (unless otherwise specified).
+
+__all__ = ['StageProfiler']
+
+# Cell
+# default_exp profiling
+import json
+import time
+import torch
+import threading
+from collections import OrderedDict
+
+from fastcore.basics import store_attr
+
+# Cell
+import sys
+sys.path.append('..')
+from .modular_unet import ModularUNet
+
+# Cell
+def _nbytes(x):
+    " Size of all tensors in `x` in bytes "
+    if isinstance(x, torch.Tensor): return x.numel() * x.element_size()
+    if isinstance(x, (list, tuple)): return sum(_nbytes(o) for o in x)
+    return 0
+
+def _shape(x):
+    if isinstance(x, torch.Tensor): return tuple(x.shape)
+    if isinstance(x, (list, tuple)): return [_shape(o) for o in x]
+    return None
+
+# Cell
+class StageProfiler():
+    " Record time, output shape and activation size of each block of a `ModularUNet` "
+    def __init__(self,
+                 model:ModularUNet, # model to profile
+                 children=False, # also record the direct children of each block
+                ):
+        store_attr()
+        self.events, self.hooks, self.starts = [], [], {}
+        self.t0 = time.perf_counter()
+
+    def __enter__(self):
+        assert self.model.profiler is None, 'Model already has a profiler attached'
+        self.model.profiler = self
+        if self.children: self._register_child_hooks()
+        return self
+
+    def __exit__(self, *args):
+        self.model.profiler = None
+        for hook in self.hooks: hook.remove()
+        self.hooks = []
+
+    def _add_event(self, name, start, end, out):
+        self.events.append({'name': name, 'start': start - self.t0, 'duration': end - start,
+                            'shape': _shape(out), 'nbytes': _nbytes(out), 'thread': threading.get_ident()})
+
+    def record(self, name, fn, *args):
+        " Call `fn` with `args` and record it under `name` "
+        start = time.perf_counter()
+        out = fn(*args)
+        self._add_event(name, start, time.perf_counter(), out)
+        return out
+
+    def _register_child_hooks(self):
+        for block_name, block in self.model.named_children():
+            for child_name, child in block.named_children():
+                name = f'{block_name}.{child_name}'
+                def pre_hook(module, inp, name=name): self.starts[(name, threading.get_ident())] = time.perf_counter()
+                def hook(module, inp, out, name=name):
+                    self._add_event(name, self.starts.pop((name, threading.get_ident())), time.perf_counter(), out)
+                self.hooks += [child.register_forward_pre_hook(pre_hook), child.register_forward_hook(hook)]
+
+    def reset(self):
+        " Remove all recorded events "
+        self.events = []
+
+    def summary(self):
+        " Aggregate events by name: number of calls, total and mean time, last output shape and mean output size "
+        stats = OrderedDict()
+        for e in self.events:
+            s = stats.setdefault(e['name'], {'calls': 0, 'total_s': 0., 'nbytes': 0})
+            s['calls'] += 1
+            s['total_s'] += e['duration']
+            s['nbytes'] += e['nbytes']
+            s['shape'] = e['shape']
+        for s in stats.values():
+            s['mean_ms'] = s['total_s'] / s['calls'] * 1000
+            s['mean_mib'] = s.pop('nbytes') / s['calls'] / 2**20
+        return stats
+
+    def table(self, sort=False):
+        " Summary as printable table, optionally sorted by total time "
+        stats = self.summary()
+        total = sum(s['total_s'] for name, s in stats.items() if '.' not in name) or 1.
+        rows = sorted(stats.items(), key=lambda o: -o[1]['total_s']) if sort else stats.items()
+        lines = [f"{'stage':<40}{'calls':>7}{'total s':>10}{'mean ms':>10}{'%':>7}{'MiB':>10}  shape"]
+        for name, s in rows:
+            lines.append(f"{name:<40}{s['calls']:>7}{s['total_s']:>10.3f}{s['mean_ms']:>10.2f}"
+                         f"{100 * s['total_s'] / total:>7.1f}{s['mean_mib']:>10.2f}  {s['shape']}")
+        return '\n'.join(lines)
+
+    def chrome_trace(self):
+        " Events in Chrome trace format, which can be loaded in chrome://tracing or Perfetto "
+        return {'traceEvents': [{'name': e['name'], 'ph': 'X', 'pid': 0, 'tid': e['thread'],
+                                 'ts': e['start'] * 1e6, 'dur': e['duration'] * 1e6,
+                                 'args': {'shape': str(e['shape']), 'nbytes': e['nbytes']}} for e in self.events]}
+
+    def export_chrome_trace(self, fname):
+        " Save events as Chrome trace to `fname` "
+        with open(fname, 'w') as f: json.dump(self.chrome_trace(), f)
\ No newline at end of file
@@ -0,0 +1,83 @@
+# AUTOGENERATED! DO NOT EDIT! File to edit: nbs/quantization.ipynb (unless otherwise specified).
+
+__all__ = ['quantize', 'dice_score', 'quantization_report']
+
+# Cell
+# default_exp quantization
+import time
+import torch
+from copy import deepcopy
+from itertools import chain
+from torch.ao.quantization import get_default_qconfig_mapping
+from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+# Cell
+import sys
+sys.path.append('..')
+from .modular_unet import ModularUNet
+from .blocks import SpatialAttentionDualInput
+from .optimize import StaticUNet
+
+# Cell
+def quantize(model:ModularUNet,
+             calibration_batches, # iterable of input batches to calibrate activation ranges
+             backend='x86' # quantized engine, 'x86' or 'fbgemm' for x86 CPUs
+            ):
+    " Quantize weights and activations of a copy of `model` to int8 with static post-training quantization "
+    engine = torch.backends.quantized.engine
+    torch.backends.quantized.engine = backend # the engine is global, restore it afterwards
+    try:
+        qconfig_mapping = get_default_qconfig_mapping(backend).set_object_type(SpatialAttentionDualInput, None)
+        batches = iter(calibration_batches)
+        first = next(batches)
+        prepared = prepare_fx(StaticUNet(deepcopy(model).eval()), qconfig_mapping, (first, ))
+        with torch.no_grad():
+            for x in chain([first], batches): prepared(x)
+        return convert_fx(prepared)
+    finally: torch.backends.quantized.engine = engine
+
+# Cell
+def dice_score(pred, target, n_classes):
+    " Mean Dice score of the label maps `pred` and `target` over all classes present in either of them "
+    scores = []
+    for c in range(n_classes):
+        p, t = pred == c, target == c
+        total = p.sum() + t.sum()
+        if total > 0: scores.append((2 * (p & t).sum() / total).item())
+    return sum(scores) / len(scores)
+
+# Cell
+def _latency(model, x, n_iter):
+    times = []
+    for _ in range(n_iter + 1): # first iteration is warmup
+        start = time.perf_counter()
+        model(x)
+        times.append(time.perf_counter() - start)
+    return min(times[1:])
+
+@torch.no_grad()
+def quantization_report(model:ModularUNet,
+                        qmodel, # quantized `model` from `quantize`
+                        batches, # iterable of input batches to compare on, not used for calibration
+                        targets=None, # optional iterable of label maps with shape (batch_size, *spatial_dims) for `batches`
+                        n_iter=3 # timed iterations per batch
+                       ):
+    " Speedup of `qmodel` over `model` and drift of its predictions "
+    model.eval()
+    float_s, int8_s, dice, accuracy, dice_float, dice_int8 = [], [], [], [], [], []
+    for x, y in zip(batches, targets if targets is not None else iter(lambda: None, 0)):
+        pred, qpred = model(x).argmax(1), qmodel(x).argmax(1)
+        float_s.append(_latency(model, x, n_iter))
+        int8_s.append(_latency(qmodel, x, n_iter))
+        dice.append(dice_score(qpred, pred, model.n_classes))
+        accuracy.append((qpred == pred).float().mean().item())
+        if y is not None:
+            dice_float.append(dice_score(pred, y, model.n_classes))
+            dice_int8.append(dice_score(qpred, y, model.n_classes))
+    mean = lambda o: sum(o) / len(o)
+    report = {'float_s': mean(float_s), 'int8_s': mean(int8_s), 'speedup': sum(float_s) / sum(int8_s),
+              'dice_vs_float': mean(dice), 'accuracy_vs_float': mean(accuracy)}
+    if dice_float:
+        report.update({'dice_float': mean(dice_float), 'dice_int8': mean(dice_int8),
+                       'dice_drift': mean(dice_int8) - mean(dice_float)})
+    return report
\ No newline at end of file
@@ -0,0 +1,173 @@
+# AUTOGENERATED! DO NOT EDIT! File to edit: nbs/serving.ipynb (unless otherwise specified).
+
+__all__ = ['BatchingPredictor', 'serve_http']
+
+# Cell
+# default_exp serving
+import time
+import json
+import queue
+import torch
+import asyncio
+import threading
+from torch import nn
+from collections import deque
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Cell
+import sys
+sys.path.append('..')
+from .modular_unet import ModularUNet
+from .utils import percentile
+
+# Cell
+class BatchingPredictor():
+    " Group single requests of the same shape into batches and run them with `model` on worker threads "
+    def __init__(self,
+                 model:ModularUNet, # a trained `ModularUNet` subclass or any callable on batches, e.g. `OnnxPredictor`
+                 max_batch_size=8, # maximum number of requests per forward pass
+                 max_delay=0.01, # seconds the oldest request waits for more requests before a smaller batch is run
+                 max_queue=64, # maximum number of pending requests, `submit` blocks while the queue is full
+                 n_workers=1, # number of worker threads running the model
+                 n_threads=None, # intra-op threads of PyTorch while the predictor is open, `n_workers * n_threads` should not exceed the cores
+                ):
+        self.model, self.max_batch_size, self.max_delay, self.max_queue = model, max_batch_size, max_delay, max_queue
+        self.metrics = deque(maxlen=10000) # per request metrics of the most recent requests
+        self._groups, self._pending, self._closed = {}, 0, False
+        self._cond = threading.Condition()
+        self._threads = torch.get_num_threads()
+        if n_threads: torch.set_num_threads(n_threads)
+        self._workers = [threading.Thread(target=self._work, daemon=True) for _ in range(n_workers)]
+        for w in self._workers: w.start()
+
+    def submit(self, x, timeout=None):
+        " Queue a single input `x` without batch dimension and return a `Future` of its prediction. Raises `queue.Full` if the queue is still full after `timeout` seconds "
+        future = Future()
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._pending < self.max_queue or self._closed, timeout):
+                raise queue.Full(f'{self.max_queue} requests are pending')
+            if self._closed: raise RuntimeError('The predictor is closed')
+            self._groups.setdefault(tuple(x.shape), deque()).append((x, future, time.perf_counter()))
+            self._pending += 1
+            self._cond.notify_all()
+        return future
+
+    def predict(self, x, timeout=None):
+        " Predict a single input `x` and wait for the result "
+        return self.submit(x, timeout).result()
+
+    async def apredict(self, x):
+        " Predict a single input `x` from a coroutine without blocking the event loop "
+        try: future = self.submit(x, timeout=0)
+        except queue.Full: future = await asyncio.get_running_loop().run_in_executor(None, self.submit, x)
+        return await asyncio.wrap_future(future)
+
+    def _next_batch(self):
+        " Wait until a batch is full or the oldest request is due. Returns `None` once closed and drained "
+        with self._cond:
+            while True:
+                if not self._groups:
+                    if self._closed: return None
+                    self._cond.wait()
+                    continue
+                key = next((k for k, g in self._groups.items() if len(g) >= self.max_batch_size), None)
+                if key is None: # no full batch, run the group of the oldest request once it is due
+                    key = min(self._groups, key=lambda k: self._groups[k][0][2])
+                    wait = self._groups[key][0][2] + self.max_delay - time.perf_counter()
+                    if wait > 0 and not self._closed:
+                        self._cond.wait(wait)
+                        continue
+                group = self._groups[key]
+                batch = [group.popleft() for _ in range(min(len(group), self.max_batch_size))]
+                if not group: del self._groups[key]
+                self._pending -= len(batch)
+                self._cond.notify_all() # wake up blocked `submit` calls
+                return [r for r in batch if r[1].set_running_or_notify_cancel()]
+
+    def _work(self):
+        " Run batches until the predictor is closed "
+        while True:
+            batch = self._next_batch()
+            if batch is None: return
+            if not batch: continue # all requests were cancelled
+            xs, futures, starts = zip(*batch)
+            start = time.perf_counter()
+            try:
+                param = next(self.model.parameters(), None) if isinstance(self.model, nn.Module) else None
+                x = torch.stack(xs)
+                with torch.no_grad(): out = self.model(x if param is None else x.to(param.device)).to(x.device)
+            except Exception as e:
+                for f in futures: f.set_exception(e)
+                continue
+            end = time.perf_counter()
+            for f, o, s in zip(futures, out, starts):
+                self.metrics.append({'queue_s': start - s, 'latency_s': end - s, 'batch_size': len(batch)})
+                f.set_result(o)
+
+    def latency_summary(self):
+        " Number of requests, mean batch size and percentiles of queueing time and latency of the recent requests "
+        metrics = list(self.metrics)
+        if not metrics: return {'n_requests': 0}
+        queued, latency = [m['queue_s'] for m in metrics], [m['latency_s'] for m in metrics]
+        return {'n_requests': len(metrics), 'mean_batch_size': sum(m['batch_size'] for m in metrics) / len(metrics),
+                'queue_p50_s': percentile(queued, 50), 'latency_p50_s': percentile(latency, 50),
+                'latency_p95_s': percentile(latency, 95)}
+
+    def close(self):
+        " Run the pending requests, stop the workers and restore the number of intra-op threads "
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        for w in self._workers: w.join()
+        torch.set_num_threads(self._threads)
+
+    def __enter__(self): return self
+    def __exit__(self, *args): self.close()
+
+# Cell
+def serve_http(predictor:BatchingPredictor,
+               host='127.0.0.1',
+               port=0, # 0 picks a free port, see `server.server_address`
+               timeout=1., # seconds to wait for space in the queue before answering with 503
+               max_bytes=2**30 # largest request body, larger requests are answered with 413 without reading them
+              ):
+    " Serve `predictor` in a background thread: POST inputs to /predict, GET /metrics. Stop with `server.shutdown()` "
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            if self.path != '/predict': return self.send_error(404)
+            if self.headers['Content-Length'] is None: return self.send_error(411)
+            try: n_bytes = int(self.headers['Content-Length'])
+            except ValueError: n_bytes = -1
+            if n_bytes < 0: return self.send_error(400, 'Bad request', 'Content-Length is not a valid length')
+            if n_bytes > max_bytes: return self.send_error(413, 'Request too large', f'The body can have at most {max_bytes} bytes')
+            data = bytearray(self.rfile.read(n_bytes))
+            try:
+                shape = [int(s) for s in self.headers['X-Shape'].split(',')]
+                if min(shape) < 1: raise ValueError('all sizes must be positive')
+                x = torch.frombuffer(data, dtype=torch.float32).view(shape)
+            except (AttributeError, ValueError, RuntimeError) as e: # missing or malformed header, size mismatch
+                return self.send_error(400, 'Bad request', f'Expected float32 data and its shape in X-Shape: {e}')
+            try:
+                out = predictor.predict(x, timeout)
+                body = out.float().contiguous().numpy().tobytes()
+            except queue.Full: return self.send_error(503, 'Too many pending requests')
+            except Exception as e: return self.send_error(500, 'Prediction failed', str(e))
+            self.reply(body, 'application/octet-stream', {'X-Shape': ','.join(str(s) for s in out.shape)})
+
+        def do_GET(self):
+            if self.path != '/metrics': return self.send_error(404)
+            self.reply(json.dumps(predictor.latency_summary()).encode(), 'application/json')
+
+        def reply(self, body, content_type, headers=None):
+            self.send_response(200)
+            headers = {'Content-Type': content_type, 'Content-Length': str(len(body)), **(headers or {})}
+            for k, v in headers.items(): self.send_header(k, v)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args): pass # do not log every request
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
\ No newline at end of file
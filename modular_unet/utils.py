@@ -1,6 +1,6 @@
 # AUTOGENERATED! DO NOT EDIT! File to edit: nbs/utils.ipynb (unless otherwise specified).
 
-__all__ = ['all_equal', 'first_layer', 'hasattrs', 'test_forward']
+__all__ = ['all_equal', 'first_layer', 'hasattrs', 'percentile', 'test_forward']
 
 # Cell
 # default_exp utils
@@ -33,6 +33,14 @@ def hasattrs(x, attrs, do_raise=False):
         raise ValueError(f'{x.__class__.__name__} has no attributes {attrs}')
     return all_present
 
+# Cell
+def percentile(values, q):
+    " `q`-th percentile of `values` with linear interpolation "
+    values = sorted(values)
+    pos = (len(values) - 1) * q / 100
+    lo, hi = int(pos), min(int(pos) + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (pos - lo)
+
 # Cell
 def test_forward(model, inp_sz = (10, 25, 25), check_size=True):
     try: in_c = first_layer(model).in_channels